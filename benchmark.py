@@ -0,0 +1,480 @@
+"""Offline benchmark for the bots and chatbotd.
+
+Drives handle_text, handle_voice, forward_message and chatbotd's /ask with
+synthetic updates. Telegram, OpenAI and Google are replaced by local fakes
+with configurable latency and failure rates, so runs are repeatable on any
+Linux box without credentials or network access.
+
+    python benchmark.py --scenario all --messages 2000 --users 1000
+    python benchmark.py --scenario text --async-mode --openai-latency 0.8 --output bench_output.txt
+
+Reports p50/p95/p99 latency, messages per second, memory growth per 1k
+users and disk bytes written per turn for each scenario.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import openai
+from google.api_core import exceptions as google_errors
+
+import clients
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+
+class Backend:
+    """Latency and failure rate of one fake service."""
+
+    def __init__(self, name, latency, failure_rate, error):
+        self.name = name
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.error = error
+        self.calls = 0
+
+    def delay(self):
+        # Exponential around the mean, like real service times
+        return random.expovariate(1 / self.latency) if self.latency else 0
+
+    def _maybe_fail(self):
+        self.calls += 1
+        if random.random() < self.failure_rate:
+            raise self.error(f"injected {self.name} failure")
+
+    def call(self):
+        time.sleep(self.delay())
+        self._maybe_fail()
+
+    async def acall(self):
+        await asyncio.sleep(self.delay())
+        self._maybe_fail()
+
+
+# Fake OpenAI
+
+def fake_openai(backend, reply_words=60):
+    words = "the quick brown fox jumps over the lazy dog and keeps running".split()
+
+    def reply():
+        return " ".join(random.choice(words) for _ in range(reply_words)) + "."
+
+    def response(messages):
+        text = reply()
+        usage = {"prompt_tokens": sum(len(m["content"]) // 4 for m in messages), "completion_tokens": len(text) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        return {"choices": [{"message": {"role": "assistant", "content": text}}], "usage": usage}
+
+    def create(model, messages, stream=False, **params):
+        backend.call()
+        return response(messages)
+
+    async def acreate(model, messages, stream=False, **params):
+        await backend.acall()
+        if not stream:
+            return response(messages)
+
+        async def chunks():
+            for word in reply().split(" "):
+                await asyncio.sleep(backend.latency / reply_words / 4)
+                yield {"choices": [{"delta": {"content": word + " "}}]}
+        return chunks()
+
+    openai.ChatCompletion.create = create
+    openai.ChatCompletion.acreate = acreate
+
+
+# Fake Google clients, installed in the clients registry
+
+class FakeTranslate:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def detect_language(self, text):
+        self.backend.call()
+        return {"language": "zh-CN" if re.search(r"[一-鿿]", text) else "en"}
+
+    def translate(self, texts, target_language):
+        self.backend.call()
+        if isinstance(texts, str):
+            return {"translatedText": f"[{target_language}] {texts}"}
+        return [{"translatedText": f"[{target_language}] {text}"} for text in texts]
+
+
+class FakeSpeech:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def streaming_recognize(self, config, requests):
+        size = sum(len(request.audio_content) for request in requests)
+        self.backend.call()
+        result = SimpleNamespace(is_final=True, alternatives=[SimpleNamespace(transcript=f"voice note of {size} bytes")])
+        return [SimpleNamespace(results=[result])]
+
+
+class FakeTTS:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def synthesize_speech(self, request):
+        self.backend.call()
+        return SimpleNamespace(audio_content=os.urandom(len(request["input"].text) * 40))
+
+
+def fake_google(backend):
+    clients._clients["translate"] = FakeTranslate(backend)
+    clients._clients["speech"] = FakeSpeech(backend)
+    clients._clients["tts"] = FakeTTS(backend)
+
+
+# Fake Telegram
+
+class FakeBot:
+    def __init__(self, backend, on_send=None):
+        self.backend = backend
+        self.on_send = on_send
+        self.username = "benchbot"
+        self.id = 1
+        self.file_ids = itertools.count()
+
+    def send_chat_action(self, chat_id, action):
+        self.backend.call()
+
+    def get_file(self, file_id):
+        self.backend.call()
+        return SimpleNamespace(file_path="voice.oga", download_as_bytearray=lambda: bytearray(os.urandom(16 * 1024)))
+
+    def send_audio(self, chat_id, audio, **kwargs):
+        self.backend.call()
+        return SimpleNamespace(audio=SimpleNamespace(file_id=f"audio-{next(self.file_ids)}"))
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.backend.call()
+        if self.on_send is not None:
+            self.on_send(text)
+        return FakeMessage(self, chat_id, chat_id, text)
+
+
+class FakeMessage:
+    def __init__(self, bot, chat_id, user_id, text, chat_type="private", voice=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.chat = SimpleNamespace(id=chat_id, type=chat_type, title=f"chat {chat_id}")
+        self.from_user = SimpleNamespace(id=user_id, first_name=f"user{user_id}", username=None)
+        self.text = text
+        self.entities = []
+        self.voice = voice
+        self.reply_to_message = None
+
+    def reply_text(self, text, **kwargs):
+        return self.bot.send_message(self.chat_id, text)
+
+    def edit_text(self, text, **kwargs):
+        self.bot.backend.call()
+        return self
+
+
+def fake_update(bot, user_id, text=None, voice=False, chat_type="private", update_id=0):
+    message = FakeMessage(bot, user_id, user_id, text, chat_type, SimpleNamespace(file_id=f"voice-{user_id}") if voice else None)
+    return SimpleNamespace(message=message, effective_user=message.from_user, effective_chat=message.chat,
+                           update_id=update_id, to_dict=lambda: {"update_id": update_id})
+
+
+# Measurements
+
+def rss_bytes():
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def written_bytes():
+    # Bytes handed to write(), cache hits included
+    try:
+        with open("/proc/self/io") as file:
+            for line in file:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def tree_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Run:
+    """Collects one scenario's latencies and resource use."""
+
+    def __init__(self, name, users, data_dir=None):
+        self.name = name
+        self.users = users
+        self.data_dir = data_dir
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+
+    def __enter__(self):
+        self.rss = rss_bytes()
+        self.written = written_bytes()
+        self.stored = tree_bytes(self.data_dir) if self.data_dir else 0
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
+        self.rss = rss_bytes() - self.rss
+        self.written = written_bytes() - self.written
+        self.stored = (tree_bytes(self.data_dir) if self.data_dir else 0) - self.stored
+
+    def record(self, latency, failed=False):
+        with self.lock:
+            self.latencies.append(latency)
+            self.errors += failed
+
+    def report(self):
+        turns = max(1, len(self.latencies))
+        return {
+            "scenario": self.name,
+            "messages": len(self.latencies),
+            "errors": self.errors,
+            "seconds": round(self.elapsed, 3),
+            "msgs_per_s": round(len(self.latencies) / self.elapsed, 1) if self.elapsed else 0.0,
+            "p50_ms": round(percentile(self.latencies, 0.50) * 1000, 1),
+            "p95_ms": round(percentile(self.latencies, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(self.latencies, 0.99) * 1000, 1),
+            "rss_per_1k_users": round(self.rss / self.users * 1000),
+            "written_per_turn": round(self.written / turns),
+            "stored_per_turn": round(self.stored / turns),
+        }
+
+
+# Scenarios
+
+def pace(args, i, started):
+    # Open-loop arrivals at --rate messages per second, 0 sends everything at once
+    if args.rate:
+        delay = started + i / args.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def run_bot(args, voice):
+    import bot
+    from inbox import Inbox
+    from telegram.error import NetworkError
+
+    telegram = Backend("telegram", args.telegram_latency, args.failure_rate, NetworkError)
+    fake_bot = FakeBot(telegram)
+    context = SimpleNamespace(bot=fake_bot, args=[])
+    # Turns are journalled and retried like in bot.main()
+    if bot.inbox is None:
+        bot.inbox = Inbox(os.path.join(bot.user_data_path, "inbox.log"))
+    handler = bot.traced(bot.durable(bot.handle_voice if voice else bot.handle_text))
+    run = Run("voice" if voice else "text", args.users, bot.user_data_path)
+
+    if args.async_mode and bot.pipeline is None:
+        bot.pipeline = bot.UserPipeline(max_concurrency=args.concurrency).start()
+
+    with run:
+        futures = []
+        for i in range(args.messages):
+            pace(args, i, run.started)
+            user_id = 100000 + i % args.users
+            update = fake_update(fake_bot, user_id, text=None if voice else f"question {i} from {user_id}", voice=voice,
+                                 update_id=i)
+            started = time.perf_counter()
+            bot.journal(update)
+            if bot.pipeline is None:
+                # The dispatcher's default: one update after the other
+                try:
+                    bot.run_handler(None, str(user_id), handler, update, context)
+                    run.record(time.perf_counter() - started)
+                except Exception:
+                    run.record(time.perf_counter() - started, failed=True)
+                continue
+            future = bot.pipeline.submit(str(user_id), handler, update, context)
+            future.add_done_callback(
+                lambda f, started=started: run.record(time.perf_counter() - started, failed=f.exception() is not None))
+            futures.append(future)
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+        bot.history_store.flush()
+    return run.report()
+
+
+def run_forward(args):
+    import forwardbot
+    from config_store import ConfigStore
+    from engine import ChatEngine
+    from send_queue import SendScheduler
+    from translator import TranslationBatcher
+
+    path = os.path.join(os.getcwd(), ".forward.json")
+    with open(path, "w") as file:
+        json.dump({"DESTINATION_CHAT_ID": 1, "SOURCE_CHATS": {}, "PAUSED_CHATS": []}, file)
+    forwardbot.data = ConfigStore(path)
+    forwardbot.data.load()
+
+    run = Run("forward", args.users)
+    sent_at = {}
+
+    def on_send(text):
+        now = time.perf_counter()
+        for tag in re.findall(r"#(\d+)#", text):
+            started = sent_at.pop(int(tag), None)
+            if started is not None:
+                run.record(now - started)
+
+    telegram = Backend("telegram", args.telegram_latency, 0.0, RuntimeError)
+    fake_bot = FakeBot(telegram, on_send)
+    forwardbot.engine = ChatEngine("gpt-4-0613")
+    forwardbot.send_queue = SendScheduler(fake_bot, chat_rate=args.chat_rate, chat_burst=3, global_rate=30,
+                                          coalesce=args.coalesce)
+    forwardbot.batcher = TranslationBatcher(forwardbot.translate_many_to_chineseViaGoogle)
+    texts = ["Bitcoin breaks a new high as volume grows", "以太坊升级将在下周完成", "The node release fixes a memory leak"]
+    # langdetect loads its profiles on first use, keep that out of the numbers
+    forwardbot.is_chinese(texts[0])
+
+    with run:
+        for i in range(args.messages):
+            pace(args, i, run.started)
+            chat_id = -1000 - i % args.users
+            update = fake_update(fake_bot, chat_id, text=f"#{i}# {texts[i % len(texts)]}", chat_type="supergroup")
+            sent_at[i] = time.perf_counter()
+            forwardbot.forward_message(update, None)
+        deadline = time.monotonic() + args.drain_timeout
+        while sent_at and time.monotonic() < deadline:
+            time.sleep(0.05)
+        run.errors += len(sent_at)
+    forwardbot.data.flush()
+    return run.report()
+
+
+def run_ask(args):
+    import chatbotd
+
+    run = Run("ask", args.users)
+    client = chatbotd.app.test_client()
+
+    async def ask(i, slots):
+        # Every repeat_ratio-th question was asked before and can come from the cache
+        topic = i % max(1, int(args.messages * (1 - args.repeat_ratio)))
+        messages = [{"role": "user", "content": f"question number {topic}"}]
+        async with slots:
+            started = time.perf_counter()
+            response = await client.post("/ask", json={"input": messages})
+            run.record(time.perf_counter() - started, failed=response.status_code != 200)
+
+    async def main():
+        slots = asyncio.Semaphore(args.concurrency)
+        await asyncio.gather(*(ask(i, slots) for i in range(args.messages)))
+
+    with run:
+        asyncio.run(main())
+    return run.report()
+
+
+def prepare_workdir(args):
+    # bot.py and chatbotd.py read .secret.json from the working directory
+    workdir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    config = {
+        "TELEGRAM_BOT_TOKEN": "bench",
+        "OPENAI_KEY": "bench",
+        "GOOGLE_CLOUD_KEY_FILE": "",
+        "ASYNC_MODE": args.async_mode,
+        "MAX_CONCURRENT_TURNS": args.concurrency,
+        "MAX_CONCURRENT_REQUESTS": args.concurrency,
+        "STREAM_REPLIES": args.stream,
+        "STREAM_EDIT_INTERVAL": 0.0,
+        "MAX_RETRIES": 3,
+    }
+    with open(os.path.join(workdir, ".secret.json"), "w") as file:
+        json.dump(config, file)
+    os.chdir(workdir)
+    return workdir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scenario", choices=["text", "voice", "forward", "ask", "all"], default="all")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rate", type=float, default=0.0, help="arrivals per second, 0 for one burst")
+    parser.add_argument("--async-mode", action="store_true", help="run bot handlers on the per-user pipeline")
+    parser.add_argument("--stream", action="store_true", help="stream replies with message edits")
+    parser.add_argument("--openai-latency", type=float, default=0.05)
+    parser.add_argument("--google-latency", type=float, default=0.01)
+    parser.add_argument("--telegram-latency", type=float, default=0.005)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of calls that fail, per fake backend")
+    parser.add_argument("--chat-rate", type=float, default=1 / 3, help="forwardbot messages per second per chat")
+    parser.add_argument("--coalesce", action="store_true", help="join queued forwards to the same chat")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="share of /ask questions asked before")
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also append the JSON report to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary working directory")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    sys.path.insert(0, REPO)
+    workdir = prepare_workdir(args)
+    fake_openai(Backend("openai", args.openai_latency, args.failure_rate, openai.error.APIError))
+    fake_google(Backend("google", args.google_latency, args.failure_rate, google_errors.ServiceUnavailable))
+
+    scenarios = ["text", "voice", "forward", "ask"] if args.scenario == "all" else [args.scenario]
+    reports = []
+    try:
+        for scenario in scenarios:
+            if scenario == "forward":
+                report = run_forward(args)
+            elif scenario == "ask":
+                report = run_ask(args)
+            else:
+                report = run_bot(args, voice=scenario == "voice")
+            reports.append(report)
+            print(json.dumps(report))
+    finally:
+        os.chdir(REPO)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "a") as file:
+            for report in reports:
+                file.write(json.dumps(report) + "\n")
+
+
+if __name__ == "__main__":
+    main()
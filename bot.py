@@ -1,20 +1,41 @@
+import asyncio
+import atexit
+import datetime
 import json
 import logging
 import os
+import re
+import sys
 import openai
 import requests
 from typing import Dict, Any
 
 import telegram
 from telegram import Update, ChatAction
+from telegram.error import BadRequest
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
 from google.cloud import texttospeech
 from google.cloud import speech_v1p1beta1 as speech
 from google.cloud import language_v1
 
-# This dictionary will store the chat history for each user
-user_chat_history = {}
-user_chat_voice = {}
+import clients
+import metrics
+import resilience
+import state
+import webhook
+from cache import LRUCache
+from engine import RETRYABLE_ERRORS, ChatEngine
+from history_store import HistoryStore, is_valid_name
+from inbox import Inbox
+from language import LanguageDetector, normalize_code
+from context_window import MODEL_CONTEXT_WINDOWS, message_tokens
+from pipeline import UserPipeline, run_blocking, run_handler
+from routing import AddressedToBot, MentionedCommand, text_after_mention
+from settings import SettingsStore
+from speech_cache import SpeechCache, speech_key
+from streaming import StreamingReply
+from summary import Summarizer, with_summary
+
 user_data_path = "./user_data/"
 chat_model = "gpt-4-0613"
 # chat_model = "gpt-3.5-turbo-16k-0613"
@@ -25,33 +46,120 @@ with open(".secret.json") as f:
     TELEGRAM_BOT_TOKEN = config['TELEGRAM_BOT_TOKEN']
     OPENAI_KEY = config['OPENAI_KEY']
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = config['GOOGLE_CLOUD_KEY_FILE']
+    # Run handlers as coroutines on a shared event loop, ordered per user
+    ASYNC_MODE = config.get('ASYNC_MODE', False)
+    MAX_CONCURRENT_TURNS = config.get('MAX_CONCURRENT_TURNS', 32)
+    HISTORY_FLUSH_INTERVAL = config.get('HISTORY_FLUSH_INTERVAL', 1.0)
+    CACHE_MAX_USERS = config.get('CACHE_MAX_USERS', 1000)
+    CACHE_MAX_BYTES = config.get('CACHE_MAX_BYTES', 64 * 1024 * 1024)
+    # Show replies while they are generated, editing at most once per interval
+    STREAM_REPLIES = config.get('STREAM_REPLIES', False)
+    STREAM_EDIT_INTERVAL = config.get('STREAM_EDIT_INTERVAL', 1.0)
+    STREAM_GROUP_EDIT_INTERVAL = config.get('STREAM_GROUP_EDIT_INTERVAL', 3.0)
+    SPEECH_CACHE_MEMORY_BYTES = config.get('SPEECH_CACHE_MEMORY_BYTES', 32 * 1024 * 1024)
+    SPEECH_CACHE_DISK_BYTES = config.get('SPEECH_CACHE_DISK_BYTES', 512 * 1024 * 1024)
+    # "polling", or "webhook" to receive updates over HTTP and spread them over partitions
+    UPDATE_MODE = config.get('UPDATE_MODE', "polling")
+    WEBHOOK_URL = config.get('WEBHOOK_URL')
+    WEBHOOK_LISTEN = config.get('WEBHOOK_LISTEN', "0.0.0.0")
+    WEBHOOK_PORT = config.get('WEBHOOK_PORT', 8443)
+    WEBHOOK_PARTITIONS = config.get('WEBHOOK_PARTITIONS', 4)
+    # Local port for /metrics (Prometheus) and /profile, off when not set
+    METRICS_PORT = config.get('METRICS_PORT')
+    # Older turns are folded into a summary once the rest exceeds this many tokens, 0 turns it off
+    SUMMARY_TRIGGER_TOKENS = config.get('SUMMARY_TRIGGER_TOKENS', 3000)
+    SUMMARY_KEEP_TOKENS = config.get('SUMMARY_KEEP_TOKENS', 1500)
+    SUMMARY_MODEL = config.get('SUMMARY_MODEL', "gpt-3.5-turbo")
+    # Below this confidence the local language guess is checked with Google
+    LANGUAGE_CONFIDENCE = config.get('LANGUAGE_CONFIDENCE', 0.8)
+    # A turn that failed on a transient error is run again up to this many times
+    TURN_RETRIES = config.get('TURN_RETRIES', 2)
+    # A backend is not called for BREAKER_RESET seconds after BREAKER_FAILURES failures in a row
+    BREAKER_FAILURES = config.get('BREAKER_FAILURES', 5)
+    BREAKER_RESET = config.get('BREAKER_RESET', 30)
+
+resilience.configure(BREAKER_FAILURES, BREAKER_RESET)
+
+clients.configure_openai(OPENAI_KEY)
+# Model routing, context budgets, timeouts and retries for every OpenAI call
+engine = ChatEngine.from_config(config, chat_model)
+
+# Queues between the webhook ingress and the workers (STATE_BACKEND)
+state_backend = state.open_backend(config)
+
+# Chat histories are appended to per-user logs and fsynced in batches
+history_store = HistoryStore(user_data_path, flush_interval=HISTORY_FLUSH_INTERVAL)
+atexit.register(history_store.close)
+
+# Voice switch, TTS language and voice, model and context budget per user
+user_settings = SettingsStore(f"{user_data_path}settings.db")
+atexit.register(user_settings.close)
+
+def conversation_size(messages):
+    # Rough in-memory footprint of a message list, per-message overhead included
+    return sum(len(m.get("content") or "") + 200 for m in messages)
+
+def evict_chat(user_id, messages):
+    # Store the chat, then let the store drop its per-user state as well
+    history_store.save(user_id, messages)
+    history_store.forget(user_id)
+
+# This cache holds the chat history of recently active users. Evicted chats
+# are flushed to the store and reloaded on their next access.
+user_chat_history = LRUCache(
+    max_entries=CACHE_MAX_USERS,
+    max_bytes=CACHE_MAX_BYTES,
+    sizeof=conversation_size,
+    on_evict=evict_chat,
+    loader=lambda user_id: history_store.read(user_id) or [],
+)
+
+def summarize_turns(previous, messages):
+    instructions = "Summarise the conversation between the user and the assistant in at most 300 words. " \
+                   "Keep names, facts, decisions, preferences and open questions."
+    if previous:
+        instructions += f"\nExtend this summary of what came before:\n{previous}"
+    transcript = "\n\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    text, _ = engine.complete(
+        [{"role": "system", "content": instructions}, {"role": "user", "content": transcript}],
+        SUMMARY_MODEL, max_tokens=600)
+    return text
+
+# Rolling summaries of long chats, written next to the history logs
+summarizer = Summarizer(
+    history_store,
+    summarize_turns,
+    count=lambda message: message_tokens(message, chat_model),
+    trigger_tokens=SUMMARY_TRIGGER_TOKENS,
+    keep_tokens=SUMMARY_KEEP_TOKENS,
+) if SUMMARY_TRIGGER_TOKENS else None
+
+# Synthesised replies, their Telegram file_ids and detected languages
+speech_cache = SpeechCache(f"{user_data_path}/.speech_cache", SPEECH_CACHE_MEMORY_BYTES, SPEECH_CACHE_DISK_BYTES)
+
+# Set in main() when ASYNC_MODE is enabled
+pipeline = None
+# Updates whose turn hasn't finished yet, set in main()
+inbox = None
 
 def newUser(user_id, asname="default"):
-    file_path = f"{user_data_path}/{user_id}/{user_id}_{asname}.json"
-    if user_id in user_chat_history or os.path.exists(file_path):
+    if user_id in user_chat_history or history_store.exists(user_id, asname):
         return False
     return True
 
 def load_chat_history(user_id, asname="default"):
-    # Load the chat history from a file
+    # Load the chat history from the user's log
     if user_id not in user_chat_history or len(user_chat_history[user_id]) == 0:
-        file_path = f"{user_data_path}/{user_id}/{user_id}_{asname}.json"
-        if os.path.exists(file_path):
-            with open(file_path, "r") as f:
-                user_chat_history[user_id] = json.load(f)
-        else:
-            os.makedirs(f"{user_data_path}/{user_id}/", exist_ok = True)
-            with open(file_path, "w") as f:
-                json.dump([], f)
-                user_chat_history[user_id] = []
+        user_chat_history[user_id] = history_store.read(user_id, asname) or []
 
     return user_chat_history[user_id]
 
 def save_chat_history(user_id, asname="default"):
-    # Save the chat history to a file in JSON format
-    os.makedirs(f"{user_data_path}/{user_id}/", exist_ok = True)
-    with open(f"{user_data_path}/{user_id}/{user_id}_{asname}.json", "w") as f:
-        json.dump(user_chat_history[user_id], f)
+    # Only the turns added since the last save are appended to the log
+    history_store.save(user_id, user_chat_history[user_id], asname)
+    user_chat_history.resize(user_id)
+    if summarizer is not None:
+        summarizer.submit(user_id, user_chat_history[user_id], asname)
 
 
 def process_reply_message(reply):
@@ -67,40 +175,65 @@ def process_reply_message(reply):
     reply = reply.strip()
     return reply
 
-def detect_language(text):
-    from google.cloud import translate_v2 as translate
+def detect_remote_language(text):
+    # Only asked when the local model is unsure, the answer is kept on disk
+    language_code = speech_cache.get_language(text)
+    if language_code is not None:
+        return language_code
 
-    client = translate.Client()
-    response = client.detect_language(text)
+    client = clients.translate_client()
+    with clients.timed("google.detect_language"):
+        response = client.detect_language(text)
 
+    speech_cache.set_language(text, response['language'])
     return response['language']
 
-def generate_ai_response(user_id):
-    openai.api_key = OPENAI_KEY
-    if user_id not in user_chat_history:
-        user_chat_history[user_id] = []
-
-    response = openai.ChatCompletion.create(
-      model=chat_model,
-      messages=user_chat_history[user_id])
-    usage = response['usage']['total_tokens']
-    utilization = float(usage*100/4096)
-    reply_text = response['choices'][0]['message']['content'].strip()
+language_detector = LanguageDetector(remote=detect_remote_language, threshold=LANGUAGE_CONFIDENCE)
+
+def detect_language(text):
+    with metrics.timer("language.detect"):
+        return language_detector.detect(text)
+
+async def generate_ai_response(user_id, on_text=None):
+    # With on_text the reply is streamed and each new piece is passed to it.
+    # Handlers run on long-lived loops in both modes, so their session is reused.
+    clients.bind_openai_session()
+
+    # The summary of older turns plus the newest turns that fit the model's budget are sent
+    settings = await run_blocking(user_settings.get, user_id)
+    summary = await run_blocking(history_store.read_summary, user_id)
+    messages = with_summary(summary, user_chat_history[user_id])
+    prompt = engine.prepare(messages, settings["model"], settings["context_budget"])
+    utilization = float(prompt.tokens*100/prompt.budget)
+
+    # The engine guards each attempt with the openai.chat breaker itself
+    with metrics.timer("backend.openai.chat"):
+        if on_text is None:
+            reply_text, _ = await engine.acomplete(prompt.messages, prompt.model)
+        else:
+            pieces = []
+            async for delta in engine.astream(prompt.messages, prompt.model):
+                pieces.append(delta)
+                await on_text(delta)
+            reply_text = "".join(pieces).strip()
     reply_text = process_reply_message(reply_text)
 
     return reply_text, utilization
 
-def transcribe_audio(audio_file):
-    # Instantiates a client
-    client = speech.SpeechClient()
+def download_audio(audio_file, chunk_size=32 * 1024):
+    # Yield the voice note in chunks straight from Telegram, nothing touches the disk
+    if not audio_file.file_path.startswith("http"):
+        yield bytes(audio_file.download_as_bytearray())
+        return
+    with clients.timed("telegram.download"):
+        with clients.http_session().get(audio_file.file_path, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size):
+                yield chunk
 
-    # Loads the audio into memory
-    with open(audio_file, 'rb') as f:
-        content = f.read()
+def transcribe_audio(audio_chunks):
+    client = clients.speech_client()
 
-    # Specifies the audio file format
-    audio = speech.types.RecognitionAudio(content=content)
-    
     config = speech.types.RecognitionConfig(
         encoding=speech.types.RecognitionConfig.AudioEncoding.OGG_OPUS,
         sample_rate_hertz=48000,
@@ -109,146 +242,240 @@ def transcribe_audio(audio_file):
         enable_automatic_punctuation=True,
         profanity_filter=True
     )
+    streaming_config = speech.types.StreamingRecognitionConfig(config=config)
 
-    # Performs speech recognition on the audio file
-    response = client.recognize(config=config, audio=audio)
+    # Audio is recognised while it is still being downloaded
+    audio_requests = (speech.types.StreamingRecognizeRequest(audio_content=chunk) for chunk in audio_chunks)
+    with clients.timed("google.speech"):
+        responses = client.streaming_recognize(config=streaming_config, requests=audio_requests)
 
-    # Extracts the transcript from the response
-    transcript = ''
-    for result in response.results:
-        transcript += result.alternatives[0].transcript + ' '
+        # Extracts the transcript from the final results
+        transcript = ''
+        for response in responses:
+            for result in response.results:
+                if result.is_final:
+                    transcript += result.alternatives[0].transcript + ' '
 
     return transcript
 
-def synthesize_text(language_code, text):
+def synthesize_text(language_code, text, voice_name=None):
     """Synthesizes speech from the input string of text."""
-    from google.cloud import texttospeech
-
-    client = texttospeech.TextToSpeechClient()
+    client = clients.tts_client()
 
     input_text = texttospeech.SynthesisInput(text=text)
 
-    # Note: the voice can also be specified by name.
     # Names of voices can be retrieved with client.list_voices().
-    voice = texttospeech.VoiceSelectionParams(
-        language_code=language_code,
-        ssml_gender=texttospeech.SsmlVoiceGender.FEMALE,
-    )
+    if voice_name:
+        voice = texttospeech.VoiceSelectionParams(language_code=language_code, name=voice_name)
+    else:
+        voice = texttospeech.VoiceSelectionParams(
+            language_code=language_code,
+            ssml_gender=texttospeech.SsmlVoiceGender.FEMALE,
+        )
 
     audio_config = texttospeech.AudioConfig(
         audio_encoding=texttospeech.AudioEncoding.MP3
     )
 
-    response = client.synthesize_speech(
-        request={"input": input_text, "voice": voice, "audio_config": audio_config}
-    )
+    with clients.timed("google.tts"):
+        response = client.synthesize_speech(
+            request={"input": input_text, "voice": voice, "audio_config": audio_config}
+        )
 
     return response.audio_content
 
-def handle_voice(update: Update, context: CallbackContext):
-    if update.message.chat.type == 'group':
+def split_for_speech(text, first_limit=200, limit=1500):
+    # Group sentences into chunks, the first one short so its audio is ready sooner
+    sentences = re.findall(r'[^.!?。！？\n]+[.!?。！？\n]*', text)
+    chunks, current = [], ""
+    for sentence in sentences:
+        max_length = first_limit if not chunks else limit
+        if current and len(current) + len(sentence) > max_length:
+            chunks.append(current)
+            current = ""
+        current += sentence
+        while len(current) > limit:
+            chunks.append(current[:limit])
+            current = current[limit:]
+    if current.strip():
+        chunks.append(current)
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+def speech_audio(language_code, text, voice_name=None):
+    # Returns (key, audio), audio being the Telegram file_id if it was uploaded before
+    key = speech_key(text, language_code, voice_name or "FEMALE", "MP3")
+    file_id = speech_cache.get_file_id(key)
+    if file_id is not None:
+        return key, file_id
+    audio = speech_cache.get_audio(key)
+    if audio is None:
+        audio = synthesize_text(language_code, text, voice_name)
+        speech_cache.put_audio(key, audio)
+    return key, audio
+
+def upload_speech(bot, chat_id, language_code, text, key, audio, voice_name=None):
+    try:
+        with clients.timed("telegram.upload"):
+            message = bot.send_audio(chat_id=chat_id, audio=audio, performer="assistant", title="assistant")
+    except BadRequest:
+        if not isinstance(audio, str):
+            raise
+        # The stored file_id is no longer valid, upload the audio itself
+        speech_cache.forget_file_id(key)
+        key, audio = speech_audio(language_code, text, voice_name)
+        with clients.timed("telegram.upload"):
+            message = bot.send_audio(chat_id=chat_id, audio=audio, performer="assistant", title="assistant")
+    if not isinstance(audio, str) and message.audio is not None:
+        speech_cache.set_file_id(key, message.audio.file_id)
+
+# Voice name -> language codes it speaks, fetched from Google on first use
+tts_voice_list = {}
+
+def tts_voices():
+    if not tts_voice_list:
+        with clients.timed("google.tts_voices"):
+            response = clients.tts_client().list_voices()
+        tts_voice_list.update((voice.name, list(voice.language_codes)) for voice in response.voices)
+    return tts_voice_list
+
+def tts_language(value):
+    # The normalised code if some voice speaks it, e.g. "en" or "en-US", else None
+    code = normalize_code(value)
+    # Google lists Mandarin voices as cmn-CN and cmn-TW but takes zh codes too
+    listed = code.replace("zh", "cmn", 1) if code.split("-")[0] == "zh" else code
+    for codes in tts_voices().values():
+        for known in map(normalize_code, codes):
+            if listed in (known, known.split("-")[0]):
+                return code
+    return None
+
+def speech_language(settings, text):
+    # A chosen voice only speaks its own language, a preferred TTS language
+    # saves the detection call
+    if settings["tts_voice"]:
+        codes = tts_voices().get(settings["tts_voice"])
+        if codes:
+            return codes[0]
+    return settings["tts_language"] or detect_language(text)
+
+async def send_speech(context: CallbackContext, chat_id, settings, text):
+    # Send the reply as audio chunk by chunk, synthesising the next one during each upload.
+    # Failures are only logged, the text reply is sent either way.
+    chunks = split_for_speech(text)
+    if not chunks:
+        return
+    try:
+        language_code = await run_blocking(speech_language, settings, text)
+        voice_name = settings["tts_voice"]
+        pending = asyncio.ensure_future(run_blocking(speech_audio, language_code, chunks[0], voice_name))
+        for i in range(len(chunks)):
+            key, response_audio = await pending
+            if i + 1 < len(chunks):
+                pending = asyncio.ensure_future(run_blocking(speech_audio, language_code, chunks[i + 1], voice_name))
+            await run_blocking(
+                upload_speech, context.bot, chat_id, language_code, chunks[i], key, response_audio, voice_name)
+    except Exception as e:
+        logging.error(f"Sending the spoken reply to {chat_id} failed: {e}")
+
+def streaming_reply(update: Update):
+    if not STREAM_REPLIES:
         return None
+    interval = STREAM_EDIT_INTERVAL if update.message.chat.type == 'private' else STREAM_GROUP_EDIT_INTERVAL
+    return StreamingReply(update.message, interval, transform=process_reply_message)
+
+async def send_reply(update: Update, stream, text):
+    # Finish the streamed message, or send the whole reply at once
+    with clients.timed("telegram.reply"):
+        if stream is not None:
+            await stream.finish(text)
+        else:
+            await run_blocking(update.message.reply_text, text)
+
+async def take_turn(update: Update, user_id, message_text, stream):
+    # Add the message to the chat history
+    user_message = {"role": "user", "content": message_text}
+    user_chat_history[user_id].append(user_message)
+
+    # Generate a response from OpenAI
+    try:
+        reply_text, utilization = await generate_ai_response(user_id, stream and stream.feed)
+    except Exception:
+        # Take the unanswered message back out, a retry adds it again
+        history = user_chat_history[user_id]
+        if history and history[-1] is user_message:
+            history.pop()
+        # Part of the reply is already on screen, a retry would post a second one next to it
+        if stream is not None and stream.sent is not None and inbox is not None:
+            inbox.commit(update.update_id)
+        raise
+    logging.debug(f"AI: {reply_text}")
+
+    user_chat_history[user_id].append({"role": "assistant", "content": reply_text})
+
+    # Save the chat history to a file, and write it out now: the inbox commit is
+    # fsynced sooner than the store's write-behind batch
+    await run_blocking(save_chat_history, user_id)
+    await run_blocking(history_store.sync, user_id)
+    # From here on a retry would answer the same message twice
+    if inbox is not None:
+        inbox.commit(update.update_id)
+    return reply_text, utilization
 
+async def handle_voice(update: Update, context: CallbackContext):
+    # Registered for private chats only
     user_id = str(update.message.from_user.id)
     audio_file_id = update.message.voice.file_id
 
-    if newUser(user_id):
-        help(update, context)
+    if await run_blocking(newUser, user_id):
+        await run_blocking(help, update, context)
 
-    load_chat_history(user_id)
+    await run_blocking(load_chat_history, user_id)
 
     # Send a "typing" indicator while processing the audio file
-    context.bot.send_chat_action(chat_id=update.message.chat_id, action=ChatAction.TYPING)
-
-    audio_file = context.bot.get_file(audio_file_id)
-    os.makedirs(f"{user_data_path}/{user_id}/", exist_ok = True)
-    audio_path = f"{user_data_path}/{user_id}/{user_id}.ogg"
-    audio_file.download(audio_path)
+    await run_blocking(context.bot.send_chat_action, chat_id=update.message.chat_id, action=ChatAction.TYPING)
 
-    # Transcribe the audio file
-    message_text = transcribe_audio(audio_path)
-    print("Human:", message_text)
+    with clients.timed("telegram.get_file"):
+        audio_file = await run_blocking(context.bot.get_file, audio_file_id)
 
-    # Add the message to the chat history
-    user_chat_history[user_id].append({"role": "user", "content": message_text})
+    # Transcribe the voice note while it downloads
+    message_text = await run_blocking(transcribe_audio, download_audio(audio_file))
+    logging.debug(f"Human: {message_text}")
 
-    # Generate a response from OpenAI
-    reply_text, utilization = generate_ai_response(user_id)
-    print("AI:", reply_text)
+    stream = streaming_reply(update)
+    reply_text, utilization = await take_turn(update, user_id, message_text, stream)
     tips = "\n[ Chat used:%.2f%% ]" % utilization  
 
-    if 100 - utilization <= 0.01:
-        user_chat_history[user_id] = []
-        tips = tips + "\nThe chat has been reset"
-    else:
-        user_chat_history[user_id].append({"role": "assistant", "content": reply_text})
-
-    # Save the chat history to a file
-    save_chat_history(user_id)
-
     # Send the audio response to the user
-    language_code = detect_language(reply_text)
-    response_audio = synthesize_text(language_code, reply_text)
-    context.bot.send_audio(chat_id=update.message.chat_id, audio=response_audio, performer="assistant", title="assistant")
-    update.message.reply_text(reply_text+tips)
-
-def handle_text(update: Update, context: CallbackContext):
-    bot = context.bot
-    message = update.message
+    settings = await run_blocking(user_settings.get, user_id)
+    await send_speech(context, update.message.chat_id, settings, reply_text)
+    await send_reply(update, stream, reply_text+tips)
+
+async def handle_text(update: Update, context: CallbackContext):
+    # Only messages meant for the bot get here, see AddressedToBot
     user_id = str(update.message.from_user.id)
-    message_text = update.message.text
-
-    if message.chat.type == 'group':
-        if f"@{bot.username}" not in message_text and (not message.reply_to_message or message.reply_to_message.from_user.id != bot.id):
-            return None
-    pos = message_text.find(f"@{bot.username}")
-    if pos >= 0:
-        message_text = message_text[pos+len(f"@{bot.username}"):]
-
-    print(message_text, message_text.strip().lower().find('/help'))
-    if message_text.strip().lower().find('/start') == 0:
-        return start(update, context, True)
-    elif message_text.strip().lower().find('/help') == 0:
-        return help(update, context, True)
-    elif message_text.strip().lower().find('/load') == 0:
-        return load(update, context, True)
-    elif message_text.strip().lower().find('/save') == 0:
-        return save(update, context, True)
-
-    if newUser(user_id):
-        help(update, context, True)
-
-    print("Human:", message_text)
-    load_chat_history(user_id)
+    # Found by its entity, the mention may be written in any case
+    message_text = text_after_mention(update.message, context.bot.username)
 
-    # Send a "typing" indicator while processing the audio file
-    context.bot.send_chat_action(chat_id=update.message.chat_id, action=ChatAction.TYPING)
+    if await run_blocking(newUser, user_id):
+        await run_blocking(help, update, context, True)
 
-    # Add the message to the chat history
-    user_chat_history[user_id].append({"role": "user", "content": message_text})
+    logging.debug(f"Human: {message_text}")
+    await run_blocking(load_chat_history, user_id)
 
-    # Generate a response from OpenAI
-    reply_text, utilization = generate_ai_response(user_id)
-    print("AI:", reply_text)
-    tips = "\n[ Chat used:%.2f%% ]" % utilization  
-
-    if 100 - utilization <= 0.01:
-        user_chat_history[user_id] = []
-        tips = tips + "\nThe chat has been reset"
-    else:
-        user_chat_history[user_id].append({"role": "assistant", "content": reply_text})
+    # Send a "typing" indicator while processing the audio file
+    await run_blocking(context.bot.send_chat_action, chat_id=update.message.chat_id, action=ChatAction.TYPING)
 
-    # Save the chat history to a file
-    save_chat_history(user_id)
+    stream = streaming_reply(update)
+    reply_text, utilization = await take_turn(update, user_id, message_text, stream)
+    tips = "\n[ Chat used:%.2f%% ]" % utilization  
 
-    if user_id in user_chat_voice and user_chat_voice[user_id]:
+    settings = await run_blocking(user_settings.get, user_id)
+    if settings["voice"]:
         # Send the audio response to the user
-        language_code = detect_language(reply_text)
-        response_audio = synthesize_text(language_code, reply_text)
-        context.bot.send_audio(chat_id=update.message.chat_id, audio=response_audio, performer="assistant", title="assistant")
+        await send_speech(context, update.message.chat_id, settings, reply_text)
     
     # Reply to the user with the AI's response
-    update.message.reply_text(reply_text+tips)
+    await send_reply(update, stream, reply_text+tips)
 
 def start(update: Update, context: CallbackContext, force=False):
     if update.message.chat.type == 'group' and force == False:
@@ -268,16 +495,59 @@ def voice(update: Update, context: CallbackContext, force=False):
     if update.message.chat.type == 'group' and force == False:
         return
     user_id = str(update.message.from_user.id)
-    if user_id in user_chat_voice:
-        user_chat_voice[user_id] = not user_chat_voice[user_id]
-    else:
-        user_chat_voice[user_id] = True
+    settings = user_settings.update(user_id, voice=not user_settings.get(user_id)["voice"])
 
-    if user_chat_voice[user_id]:
+    if settings["voice"]:
         update.message.reply_text(f'Auto-generate voice is Enabled.')
     else:
         update.message.reply_text(f'Auto-generate voice is Disable.')
 
+# /set names and the settings they change
+SETTING_NAMES = {"language": "tts_language", "tts_voice": "tts_voice", "model": "model", "budget": "context_budget"}
+
+def show_settings(update: Update, context: CallbackContext, force=False):
+    if update.message.chat.type == 'group' and force == False:
+        return
+    user_id = str(update.message.from_user.id)
+    current = user_settings.get(user_id)
+    lines = [f"voice: {'on' if current['voice'] else 'off'}"]
+    for name, setting in SETTING_NAMES.items():
+        lines.append(f"{name}: {current[setting] if current[setting] is not None else 'default'}")
+    update.message.reply_text("\n".join(lines))
+
+def set_setting(update: Update, context: CallbackContext, force=False):
+    if update.message.chat.type == 'group' and force == False:
+        return
+    args = context.args
+    if len(args) != 2 or args[0] not in SETTING_NAMES:
+        update.message.reply_text(f'Usage: /set <{"|".join(SETTING_NAMES)}> <value|default>')
+        return
+
+    user_id = str(update.message.from_user.id)
+    name, value = args
+    if value == "default":
+        value = None
+    elif name == "model" and value not in MODEL_CONTEXT_WINDOWS:
+        update.message.reply_text(f'Unknown model. Available: {", ".join(MODEL_CONTEXT_WINDOWS)}')
+        return
+    elif name == "budget":
+        if not value.isdigit() or int(value) == 0:
+            update.message.reply_text('The budget is a number of tokens.')
+            return
+        value = int(value)
+    elif name == "language":
+        # Checked here, an unknown code would make every later voice reply fail
+        value = tts_language(value)
+        if value is None:
+            update.message.reply_text('No voice speaks that language. Use a code like en, en-US or ja.')
+            return
+    elif name == "tts_voice" and value not in tts_voices():
+        update.message.reply_text('Unknown voice. Names look like en-US-Wavenet-D.')
+        return
+
+    user_settings.update(user_id, **{SETTING_NAMES[name]: value})
+    update.message.reply_text(f'{name} set to {args[1]}.')
+
 def save(update: Update, context: CallbackContext, force=False):
     if update.message.chat.type == 'group' and force == False:
         return
@@ -289,8 +559,16 @@ def save(update: Update, context: CallbackContext, force=False):
 
     user_id = str(update.message.from_user.id)
     asname = str(args[0])
+    if not is_valid_name(asname) or asname == "default":
+        update.message.reply_text('Names can only use letters, digits, "_" and "-", up to 64 characters.')
+        return
 
-    save_chat_history(user_id, asname)
+    # Saving under a name only records a pointer to the current chat
+    if user_id in user_chat_history:
+        save_chat_history(user_id)
+    if not history_store.snapshot(user_id, "default", asname):
+        update.message.reply_text('There is no chat to save yet.')
+        return
 
     update.message.reply_text(f'"{asname}" saved.')
 
@@ -309,19 +587,59 @@ def load(update: Update, context: CallbackContext, force=False):
     user_id = str(update.message.from_user.id)
     asname = str(args[0])
 
-    user_chat_history[user_id] = []
-    load_chat_history(user_id, asname)
+    # Point the current chat at the saved one, it is copied only once it diverges
+    if not is_valid_name(asname) or not history_store.snapshot(user_id, asname, "default"):
+        update.message.reply_text(f'"{asname}" not found.')
+        return
+    # The chat itself is read on the next turn, only its last message is needed now
+    user_chat_history.pop(user_id)
+    tail = history_store.read_tail(user_id, "default", 1)
+    if not tail:
+        update.message.reply_text(f'"{asname}" is empty.')
+        return
 
-    reply_text = user_chat_history[user_id][-1]['content']
+    reply_text = tail[-1]['content']
 
     # Send the audio response to the user
-    language_code = detect_language(reply_text)
-    response_audio = synthesize_text(language_code, reply_text)
-    context.bot.send_audio(chat_id=update.message.chat_id, audio=response_audio, performer="assistant", title="assistant")
+    settings = user_settings.get(user_id)
+    try:
+        language_code = speech_language(settings, reply_text)
+        for chunk in split_for_speech(reply_text):
+            key, response_audio = speech_audio(language_code, chunk, settings["tts_voice"])
+            upload_speech(context.bot, update.message.chat_id, language_code, chunk, key, response_audio, settings["tts_voice"])
+    except Exception as e:
+        logging.error(f"Sending the spoken reply to {user_id} failed: {e}")
     
     # Reply to the user with the AI's response
     update.message.reply_text(reply_text)
 
+def describe_saved(name, entry):
+    updated = datetime.datetime.fromtimestamp(entry["updated"]).strftime("%Y-%m-%d %H:%M")
+    return f'{name} - {entry["turns"]} messages, {updated}\n  {entry["preview"]}'
+
+def list_saved(update: Update, context: CallbackContext, force=False):
+    if update.message.chat.type == 'group' and force == False:
+        return
+    user_id = str(update.message.from_user.id)
+    catalog = sorted(history_store.catalog(user_id).items(), key=lambda item: item[1]["updated"], reverse=True)
+    if not catalog:
+        update.message.reply_text('No saved chats yet, use /save <name>.')
+        return
+    update.message.reply_text("\n".join(describe_saved(name, entry) for name, entry in catalog[:50]))
+
+def search_saved(update: Update, context: CallbackContext, force=False):
+    if update.message.chat.type == 'group' and force == False:
+        return
+    if len(context.args) == 0:
+        update.message.reply_text('Please provide a search text.')
+        return
+    user_id = str(update.message.from_user.id)
+    matches = history_store.search(user_id, " ".join(context.args))
+    if not matches:
+        update.message.reply_text('No saved chat matches.')
+        return
+    update.message.reply_text("\n".join(describe_saved(name, entry) for name, entry in matches[:50]))
+
 def help(update, context, force=False):
     if update.message.chat.type == 'group' and force == False:
         return
@@ -332,7 +650,11 @@ def help(update, context, force=False):
               "/help - Get help information\n" \
               "/save <custom name> - Save current chat to the storage\n" \
               "/load <custom name> - Load a history chat to current chat\n" \
-              "/voice - enable/disable auto generate voice\n"
+              "/list - List your saved chats\n" \
+              "/search <text> - Find saved chats by name or last message\n" \
+              "/voice - enable/disable auto generate voice\n" \
+              "/settings - Show your settings\n" \
+              "/set <setting> <value|default> - Change a setting (language, tts_voice, model, budget)\n"
     # Reply to the user with the help message
     update.message.reply_text(message)
 
@@ -340,32 +662,172 @@ def error_handler(update: Update, context: CallbackContext):
     # Log the error message
     logging.error(f"Update {update} caused error {context.error}")
     # Reply to the user with a generic error message
+    if isinstance(context.error, resilience.CircuitOpenError):
+        message = "Sorry, I can't reach one of my services right now. Please try again in a minute."
+    else:
+        message = "Sorry, something went wrong. Please try again later."
     try:
-        update.message.reply_text("Sorry, something went wrong. Please try again later.")
+        update.message.reply_text(message)
     except Exception as e:
         logging.error(f"Error sending message: {e}")
 
-def main():
-    # Set up the bot and register the audio message handler
-    bot = telegram.Bot(token=TELEGRAM_BOT_TOKEN)
+def per_user(callback):
+    # Route a handler through the pipeline so one user's updates are handled in order
+    def handler(update: Update, context: CallbackContext):
+        def on_error(error):
+            context.error = error
+            error_handler(update, context)
+
+        user_id = str(update.effective_user.id)
+        if getattr(callback, "journaled", False):
+            journal(update)
+        return run_handler(pipeline, user_id, traced(callback), update, context, on_error=on_error)
+    return handler
+
+def journal(update: Update):
+    # Called on the dispatcher thread before the update is queued, so updates
+    # still waiting for their turn at a crash are replayed too
+    if inbox is not None:
+        inbox.add(update.update_id, update.to_dict())
+
+def durable(callback):
+    # Run the turn again on transient errors, unless its reply was already
+    # stored or shown, and take the update out of the inbox once it finished.
+    # per_user() journals the update before queueing it.
+    async def job(update: Update, context: CallbackContext):
+        if inbox is None:
+            return await callback(update, context)
+        try:
+            for attempt in range(TURN_RETRIES + 1):
+                try:
+                    return await callback(update, context)
+                except Exception as e:
+                    # An open breaker won't close within a retry's backoff, and the
+                    # engine has already retried OpenAI errors as often as allowed
+                    if (attempt == TURN_RETRIES or isinstance(e, (resilience.CircuitOpenError, RETRYABLE_ERRORS))
+                            or not resilience.is_transient(e) or inbox.is_committed(update.update_id)):
+                        raise
+                    logging.warning(f"Turn for update {update.update_id} failed ({e}), retrying")
+                    metrics.observe("bot.turn_retries", 1)
+                    await asyncio.sleep(resilience.backoff(attempt))
+        finally:
+            inbox.done(update.update_id)
+    job.__name__ = callback.__name__
+    job.journaled = True
+    return job
+
+def replay_inbox(dispatcher):
+    # Hand the updates a previous run accepted but didn't finish to the dispatcher again
+    for update_id, data, committed in inbox.pending():
+        if committed:
+            # The reply is stored or shown, generating it again would answer twice
+            logging.warning(f"Not replaying update {update_id}, it was already answered")
+            inbox.done(update_id)
+            continue
+        logging.info(f"Replaying update {update_id}")
+        dispatcher.process_update(Update.de_json(data, dispatcher.bot))
+
+def traced(callback):
+    # Time the whole handler and log how long each stage inside it took
+    name = f"handler.{callback.__name__}"
+    if asyncio.iscoroutinefunction(callback):
+        async def job(*args):
+            with metrics.trace(name):
+                return await callback(*args)
+    else:
+        def job(*args):
+            with metrics.trace(name):
+                return callback(*args)
+    return job
+
+def group_command(update: Update, context: CallbackContext):
+    # "@bot /command" in a group, routed by MentionedCommand
+    GROUP_COMMANDS[context.group_command[0]](update, context, True)
+
+# Commands that also work in groups when written after a mention
+GROUP_COMMANDS = {"start": start, "help": help, "load": load, "save": save}
+
+def build_updater():
     updater = Updater(token=TELEGRAM_BOT_TOKEN, use_context=True)
     dispatcher = updater.dispatcher
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("save", save))
-    dispatcher.add_handler(CommandHandler("load", load))
-    dispatcher.add_handler(CommandHandler("voice", voice))
-    dispatcher.add_handler(CommandHandler("help", help))
-    dispatcher.add_handler(MessageHandler(Filters.text & (~Filters.command), handle_text))
-    dispatcher.add_handler(MessageHandler(Filters.voice & (~Filters.command), handle_voice))
-
-    # Start the bot
-    updater.start_polling()
+    # Group messages not meant for the bot are dropped here, before a worker sees them
+    addressed = AddressedToBot()
+    dispatcher.add_handler(MessageHandler(Filters.text & MentionedCommand(GROUP_COMMANDS), per_user(group_command)))
+    dispatcher.add_handler(CommandHandler("start", per_user(start)))
+    dispatcher.add_handler(CommandHandler("save", per_user(save)))
+    dispatcher.add_handler(CommandHandler("load", per_user(load)))
+    dispatcher.add_handler(CommandHandler("list", per_user(list_saved)))
+    dispatcher.add_handler(CommandHandler("search", per_user(search_saved)))
+    dispatcher.add_handler(CommandHandler("voice", per_user(voice)))
+    dispatcher.add_handler(CommandHandler("help", per_user(help)))
+    dispatcher.add_handler(CommandHandler("settings", per_user(show_settings)))
+    dispatcher.add_handler(CommandHandler("set", per_user(set_setting)))
+    dispatcher.add_handler(MessageHandler(Filters.text & (~Filters.command) & addressed, per_user(durable(handle_text))))
+    dispatcher.add_handler(MessageHandler(Filters.voice & (~Filters.command) & Filters.chat_type.private, per_user(durable(handle_voice))))
+    dispatcher.add_error_handler(error_handler)
+    return updater
+
+def webhook_ingress():
+    # Telegram posts to WEBHOOK_URL, the path is the token so nobody else can post
+    path = f"/{TELEGRAM_BOT_TOKEN}"
+    ingress = webhook.WebhookIngress(state_backend, WEBHOOK_PARTITIONS, WEBHOOK_LISTEN, WEBHOOK_PORT, path)
+    telegram.Bot(token=TELEGRAM_BOT_TOKEN).set_webhook(url=WEBHOOK_URL.rstrip("/") + path)
+    return ingress
 
+def main():
+    # In webhook mode `python bot.py --ingress` only receives updates and
+    # `python bot.py --worker 0,1` only handles those partitions, so both can
+    # be spread over processes and machines that share a STATE_BACKEND.
+    # Without either flag one process does both.
+    split = "--ingress" in sys.argv or "--worker" in sys.argv
+    if split and not state_backend.shared:
+        # The queues would live inside each process and nothing would get through
+        sys.exit("--ingress and --worker need a shared STATE_BACKEND, e.g. redis")
+    if "--ingress" in sys.argv:
+        webhook_ingress().serve_forever()
+        return
 
-if __name__ == '__main__':
-    main()
+    global pipeline
+    if ASYNC_MODE:
+        pipeline = UserPipeline(max_concurrency=MAX_CONCURRENT_TURNS).start()
 
+    updater = build_updater()
 
+    # One inbox per process, workers of other partitions keep their own
+    global inbox
+    if UPDATE_MODE == "webhook" and "--worker" in sys.argv:
+        inbox_name = "inbox-" + sys.argv[sys.argv.index("--worker") + 1].replace(",", "-")
+    else:
+        inbox_name = "inbox"
+    inbox = Inbox(f"{user_data_path}{inbox_name}.log")
+    atexit.register(inbox.close)
+    replay_inbox(updater.dispatcher)
+
+    if METRICS_PORT:
+        metrics.gauge("bot.pipeline_pending", lambda: pipeline.pending if pipeline is not None else 0)
+        metrics.gauge("bot.openai_waiting", lambda: engine.waiting)
+        metrics.gauge("bot.openai_active", lambda: engine.active)
+        metrics.gauge("bot.cached_users", lambda: user_chat_history.stats()["entries"])
+        metrics.gauge("bot.cached_bytes", lambda: user_chat_history.stats()["bytes"])
+        metrics.gauge("bot.cache_hits", lambda: user_chat_history.stats()["hits"])
+        metrics.gauge("bot.cache_misses", lambda: user_chat_history.stats()["misses"])
+        metrics.gauge("bot.cache_evictions", lambda: user_chat_history.stats()["evictions"])
+        metrics.gauge("bot.inbox_depth", lambda: inbox.depth())
+        metrics.serve(METRICS_PORT)
+
+    if UPDATE_MODE == "webhook":
+        if "--worker" in sys.argv:
+            partitions = [int(p) for p in sys.argv[sys.argv.index("--worker") + 1].split(",")]
+        else:
+            partitions = range(WEBHOOK_PARTITIONS)
+            webhook_ingress().start()
+        webhook.start_workers(state_backend, partitions, updater.dispatcher)
+        updater.idle()
+        return
 
+    # Start the bot
+    updater.start_polling()
 
 
+if __name__ == '__main__':
+    main()
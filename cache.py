@@ -0,0 +1,169 @@
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+
+
+class LRUCache:
+    """Thread-safe LRU mapping bounded by entry count and total size.
+
+    sizeof(value) gives the accounted size of an entry, on_evict(key, value)
+    is called for every entry pushed out by the limits, and loader(key), when
+    given, fills misses in __getitem__ so evicted entries come back on demand.
+    Values that are mutated in place should be re-measured with resize().
+    With ttl, entries older than ttl seconds are treated as missing.
+    on_evict runs after the lock is released, and a lookup of a key whose
+    on_evict is still running waits for it, so a reload sees what it stored.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None, sizeof=None, on_evict=None, loader=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 0)
+        self.on_evict = on_evict
+        self.loader = loader
+        self.lock = threading.RLock()
+        self.settled = threading.Condition(self.lock)
+        # Entries pushed out but not passed to on_evict yet, and the keys still being evicted
+        self.evicted = []
+        self.evicting = Counter()
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.expires = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            self._settle(key)
+            return self._live(key)
+
+    def __getitem__(self, key):
+        with self.lock:
+            self._settle(key)
+            if self._live(key):
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+            if self.loader is None:
+                raise KeyError(key)
+        value = self.loader(key)
+        with self.lock:
+            # Another thread may have filled the entry while we were loading
+            if key in self.entries:
+                return self.entries[key]
+            self._set(key, value)
+        self._notify()
+        return value
+
+    def get(self, key, default=None):
+        with self.lock:
+            self._settle(key)
+            if self._live(key):
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self._set(key, value)
+        self._notify()
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.entries[key]
+            self.expires.pop(key, None)
+            self.total_bytes -= self.sizes.pop(key)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value = self.entries[key]
+            del self[key]
+            return value
+
+    def resize(self, key):
+        # Re-measure an entry after its value was changed in place
+        with self.lock:
+            if key in self.entries:
+                size = self.sizeof(self.entries[key])
+                self.total_bytes += size - self.sizes[key]
+                self.sizes[key] = size
+                self._evict()
+        self._notify()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _live(self, key):
+        if key not in self.entries:
+            return False
+        if self.ttl is not None and self.expires[key] <= time.monotonic():
+            del self[key]
+            return False
+        return True
+
+    def _set(self, key, value):
+        if self.ttl is not None:
+            self.expires[key] = time.monotonic() + self.ttl
+        if key in self.entries:
+            self.total_bytes -= self.sizes[key]
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self.sizes[key] = self.sizeof(value)
+        self.total_bytes += self.sizes[key]
+        self._evict()
+
+    def _evict(self):
+        # The most recently used entry is always kept, even if it alone is over the limit
+        while len(self.entries) > 1 and (
+            len(self.entries) > self.max_entries
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            key, value = self.entries.popitem(last=False)
+            self.expires.pop(key, None)
+            self.total_bytes -= self.sizes.pop(key)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.evicted.append((key, value))
+                self.evicting[key] += 1
+
+    def _settle(self, key):
+        # Called with the lock held once, waits until on_evict is done with key
+        while self.evicting[key]:
+            self.settled.wait()
+
+    def _notify(self):
+        # Runs on_evict for the entries pushed out, without holding the lock
+        with self.lock:
+            if not self.evicted:
+                return
+            evicted, self.evicted = self.evicted, []
+        for key, value in evicted:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                logging.error(f"Evicting {key} from the cache failed: {e}")
+            finally:
+                with self.lock:
+                    self.evicting[key] -= 1
+                    if not self.evicting[key]:
+                        del self.evicting[key]
+                    self.settled.notify_all()
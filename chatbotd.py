@@ -1,37 +1,168 @@
-import openai
+import asyncio
+import hashlib
 import os
+import sys
 import json
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+import time
+import clients
+import metrics
+from cache import LRUCache
+from engine import ChatEngine
+from quart import Quart, Response, g, request, jsonify
+from quart_cors import cors
 
-app = Flask(__name__)
-CORS(app, origins=["http://localhost:8000"])
+app = Quart(__name__)
+app = cors(app, allow_origin="http://localhost:8000")
 
 with open(".secret.json") as f:
     config = json.load(f)
     api_key = config['OPENAI_KEY']
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = config['GOOGLE_CLOUD_KEY_FILE']
+    # Identical requests within the TTL are answered from the cache, 0 turns it off
+    RESPONSE_CACHE_TTL = config.get('RESPONSE_CACHE_TTL', 300)
+    RESPONSE_CACHE_SIZE = config.get('RESPONSE_CACHE_SIZE', 1000)
+    # Concurrent identical requests share one upstream call
+    COALESCE_REQUESTS = config.get('COALESCE_REQUESTS', True)
+    # Local port for the bots' /metrics (Prometheus) and /profile server, off when not set
+    METRICS_PORT = config.get('METRICS_PORT')
 
-def generate_ai_response(user_messages):
-    openai.api_key = api_key
+# /metrics on the app port only answers requests from this machine
+LOCAL_ADDRESSES = {"127.0.0.1", "::1"}
 
-    response = openai.ChatCompletion.create(
-      model="gpt-3.5-turbo",
-      messages=user_messages)
-    usage = response['usage']['total_tokens']
-    utilization = float(usage*100/4096)
-    reply_text = response['choices'][0]['message']['content'].strip()
+CHAT_MODEL = "gpt-3.5-turbo"
+
+clients.configure_openai(api_key)
+# Upstream requests allowed at once come from MAX_CONCURRENT_REQUESTS, the rest wait in line
+engine = ChatEngine.from_config(config, CHAT_MODEL)
+
+response_cache = LRUCache(max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL) if RESPONSE_CACHE_TTL else None
+# Upstream calls in progress by request key, for single-flight coalescing
+in_progress = {}
+coalesced = 0
+
+@app.before_request
+async def start_timer():
+    g.start = time.perf_counter()
+
+@app.after_request
+async def record_latency(response):
+    # Keyed by route, not path, so unknown paths don't each get a histogram
+    rule = request.url_rule.rule if request.url_rule is not None else "/unmatched"
+    metrics.observe(f"chatbotd.latency{rule}", time.perf_counter() - g.start)
+    return response
+
+def request_key(user_messages, model):
+    # Requests that differ only in spacing or extra message fields share a key
+    canonical = [
+        {"role": m.get("role"), "content": " ".join((m.get("content") or "").split())}
+        for m in user_messages
+    ]
+    payload = json.dumps({"model": model, "messages": canonical}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+async def generate_ai_response(user_messages):
+    clients.bind_openai_session()
+    reply_text, prompt = await engine.acomplete(user_messages)
+    utilization = float(prompt.tokens*100/prompt.budget)
 
     return reply_text, utilization
 
+async def stream_ai_response(user_messages):
+    # Yields the reply piece by piece as the model produces it
+    clients.bind_openai_session()
+    async for delta in engine.astream(user_messages):
+        yield delta
+
+async def upstream_ai_response(key, user_messages):
+    result = await generate_ai_response(user_messages)
+    if response_cache is not None:
+        response_cache[key] = result
+    return result
+
+async def cached_ai_response(user_messages):
+    global coalesced
+    key = request_key(user_messages, CHAT_MODEL)
+    if response_cache is not None:
+        cached = response_cache.get(key)
+        if cached is not None:
+            return cached
+    if not COALESCE_REQUESTS:
+        return await upstream_ai_response(key, user_messages)
+
+    task = in_progress.get(key)
+    if task is not None:
+        coalesced += 1
+    else:
+        task = asyncio.ensure_future(upstream_ai_response(key, user_messages))
+        in_progress[key] = task
+        task.add_done_callback(lambda _: in_progress.pop(key, None))
+    # Shielded so a client that disconnects doesn't cancel the call for the others
+    return await asyncio.shield(task)
+
 @app.route("/ask", methods=["POST"])
-def ask():
-    data = request.get_json()
+async def ask():
+    data = await request.get_json()
     messages = data["input"]
 
-    response, utilization = generate_ai_response(messages)
+    response, utilization = await cached_ai_response(messages)
 
     return jsonify({"answer": response, "utilization": utilization})
 
+@app.route("/ask/stream", methods=["POST"])
+async def ask_stream():
+    # Server-sent events: one "data" event per piece of the reply, then "done"
+    data = await request.get_json()
+    messages = data["input"]
+
+    cached = response_cache.get(request_key(messages, CHAT_MODEL)) if response_cache is not None else None
+
+    async def events():
+        if cached is not None:
+            yield f"data: {json.dumps({'delta': cached[0]})}\n\n"
+            yield "event: done\ndata: {}\n\n"
+            return
+        async for delta in stream_ai_response(messages):
+            yield f"data: {json.dumps({'delta': delta})}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    response = Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+    response.timeout = None
+    return response
+
+@app.route("/metrics", methods=["GET"])
+async def get_metrics():
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        return Response("Not Found", status=404)
+    if request.args.get("format") == "prometheus":
+        return Response(metrics.prometheus(), mimetype="text/plain")
+    stats = metrics.snapshot("chatbotd.")
+    stats.update(metrics.snapshot("engine."))
+    stats.update({f"backend.{name}": stat for name, stat in clients.latency_stats().items()})
+    cache_stats = response_cache.stats() if response_cache is not None else {}
+    cache_stats["coalesced"] = coalesced
+    return jsonify({"in_flight": engine.active, "waiting": engine.waiting, "response_cache": cache_stats, "metrics": stats})
+
+def serve():
+    # Production mode: hypercorn with keep-alive, e.g. `python chatbotd.py --serve`.
+    # For several processes run `hypercorn chatbotd:app --workers N` instead.
+    from hypercorn.asyncio import serve as hypercorn_serve
+    from hypercorn.config import Config
+
+    hypercorn_config = Config()
+    hypercorn_config.bind = [config.get('BIND', "0.0.0.0:5000")]
+    hypercorn_config.keep_alive_timeout = 75
+    asyncio.run(hypercorn_serve(app, hypercorn_config))
+
+def serve_metrics():
+    # Only from __main__: hypercorn workers import the module and would all bind METRICS_PORT
+    if METRICS_PORT:
+        metrics.gauge("chatbotd.in_flight", lambda: engine.active)
+        metrics.gauge("chatbotd.waiting", lambda: engine.waiting)
+        metrics.serve(METRICS_PORT)
+
 if __name__ == "__main__":
-    app.run(port=5000, debug=True)
+    serve_metrics()
+    if "--serve" in sys.argv:
+        serve()
+    else:
+        app.run(port=5000, debug=True)
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+
+import aiohttp
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import resilience
+
+_lock = threading.Lock()
+_clients = {}
+# One aiohttp session per event loop, sessions can't be shared across loops
+_aiosessions = {}
+
+# Keep idle gRPC channels open so voice turns skip the connection and auth setup
+GRPC_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+]
+POOL_SIZE = 64
+
+
+def _get(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def _grpc_client(client_class):
+    transport_class = client_class.get_transport_class("grpc")
+    channel = transport_class.create_channel(options=GRPC_OPTIONS)
+    return client_class(transport=transport_class(channel=channel))
+
+
+def translate_client():
+    from google.cloud import translate_v2 as translate
+    return _get("translate", translate.Client)
+
+
+def speech_client():
+    from google.cloud import speech_v1p1beta1 as speech
+    return _get("speech", lambda: _grpc_client(speech.SpeechClient))
+
+
+def tts_client():
+    from google.cloud import texttospeech
+    return _get("tts", lambda: _grpc_client(texttospeech.TextToSpeechClient))
+
+
+def configure_openai(api_key):
+    # Set the key once and share one keep-alive connection pool between threads
+    openai.api_key = api_key
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount("https://", adapter)
+    openai.requestssession = session
+
+
+def http_session():
+    # Plain HTTP downloads, e.g. Telegram files, over a shared keep-alive pool
+    def factory():
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+        return session
+    return _get("http", factory)
+
+
+def bind_openai_session():
+    # Make openai's async calls in the current task reuse this loop's session
+    loop = asyncio.get_running_loop()
+    session = _aiosessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=POOL_SIZE, keepalive_timeout=60)
+        session = _aiosessions[loop] = aiohttp.ClientSession(connector=connector)
+    openai.aiosession.set(session)
+
+
+@contextmanager
+def timed(backend):
+    # Times the call and fails fast while the backend's circuit breaker is open
+    with resilience.breaker(backend).guard(), metrics.timer(f"backend.{backend}"):
+        yield
+
+
+def latency_stats():
+    return {name[len("backend."):]: stat for name, stat in metrics.snapshot("backend.").items()}
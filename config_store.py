@@ -0,0 +1,118 @@
+import json
+import logging
+import os
+import threading
+
+
+class ConfigStore:
+    """forwardbot's .forward.json kept in memory and written only when it changes.
+
+    Reads behave like a dict. Paused chats are held in a set and saved back
+    as the PAUSED_CHATS list. Any real change marks the store dirty and
+    schedules one write flush_delay seconds later, so a burst of changes
+    costs a single write. Writes go to a temporary file which is then
+    renamed over the config, so a crash never leaves it half written.
+
+    With a state backend the keys the bot changes at runtime (SHARED_KEYS
+    and PAUSED_CHATS) are kept in the backend instead, so every process
+    sees the same chats. The file then only provides the static settings.
+    """
+
+    SHARED_KEYS = ('DESTINATION_CHAT_ID', 'SOURCE_CHATS')
+
+    def __init__(self, path, flush_delay=1.0, backend=None, key="forwardbot:state"):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.backend = backend
+        self.key = key
+        self.lock = threading.RLock()
+        self.data = {}
+        self.paused = set()
+        self.dirty = False
+        self.timer = None
+
+    def load(self):
+        with open(self.path, 'r') as file:
+            data = json.load(file)
+        if self.backend is not None:
+            data.update(self.backend.get(self.key, {}))
+        with self.lock:
+            self.paused = {int(chat_id) for chat_id in data.pop('PAUSED_CHATS', [])}
+            self.data = data
+            self.dirty = False
+
+    def reload(self):
+        # The file on disk wins over changes that were not flushed yet
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            try:
+                self.load()
+                logging.info(f"Reloaded {self.path}")
+            except (OSError, ValueError) as e:
+                logging.error(f"Keeping the current config, reloading {self.path} failed: {e}")
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if self.data.get(key) != value:
+                self.data[key] = value
+                self._mark_dirty()
+
+    def set_source_chat(self, chat_id, chat_name):
+        with self.lock:
+            chats = self.data.setdefault('SOURCE_CHATS', {})
+            if chats.get(chat_id) != chat_name:
+                chats[chat_id] = chat_name
+                self._mark_dirty()
+
+    def is_paused(self, chat_id):
+        return chat_id in self.paused
+
+    def pause(self, chat_ids):
+        with self.lock:
+            before = len(self.paused)
+            self.paused.update(chat_ids)
+            if len(self.paused) != before:
+                self._mark_dirty()
+
+    def resume(self, chat_ids):
+        # Returns the chats that actually were paused
+        with self.lock:
+            resumed = self.paused.intersection(chat_ids)
+            if resumed:
+                self.paused -= resumed
+                self._mark_dirty()
+            return resumed
+
+    def _mark_dirty(self):
+        self.dirty = True
+        if self.timer is None:
+            self.timer = threading.Timer(self.flush_delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            if not self.dirty:
+                return
+            data = dict(self.data, PAUSED_CHATS=sorted(self.paused))
+            if self.backend is not None:
+                shared = {key: data[key] for key in self.SHARED_KEYS + ('PAUSED_CHATS',) if key in data}
+                self.backend.set(self.key, shared)
+                self.dirty = False
+                return
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as file:
+                json.dump(data, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+            self.dirty = False
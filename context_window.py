@@ -0,0 +1,90 @@
+import hashlib
+
+from cache import LRUCache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Context window of each model in tokens, overridable through config
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4-0613": 8192,
+    "gpt-4": 8192,
+    "gpt-4-32k-0613": 32768,
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-0613": 4096,
+    "gpt-3.5-turbo-16k-0613": 16384,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# Tokens every message costs on top of its content, and the reply primer
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+_encodings = {}
+# Token counts per (model, role, digest of content), so a message is only
+# encoded once without the cache keeping its text alive
+_message_tokens = LRUCache(max_entries=50000)
+
+
+def _encoding(model):
+    if tiktoken is None:
+        return None
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model]
+
+
+def count_tokens(text, model):
+    encoding = _encoding(model)
+    if encoding is None:
+        # Without tiktoken, roughly four characters per token
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text))
+
+
+def message_tokens(message, model):
+    role, content = message.get("role"), message.get("content") or ""
+    key = (model, role, hashlib.blake2b(content.encode(), digest_size=16).digest())
+    tokens = _message_tokens.get(key)
+    if tokens is None:
+        tokens = MESSAGE_OVERHEAD + count_tokens(role or "", model) + count_tokens(content, model)
+        _message_tokens[key] = tokens
+    return tokens
+
+
+def context_budget(model, budgets=None, reply_reserve=1024):
+    # Prompt tokens available for a model once room for the reply is set aside
+    window = (budgets or {}).get(model) or MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+    return max(window - reply_reserve, 0)
+
+
+def build_context(messages, model, budget):
+    """Returns (messages, tokens) for the newest turns that fit in budget.
+
+    System messages are always kept, the oldest other turns are dropped
+    first and the latest message is sent even if it alone is over budget.
+    """
+    system = [m for m in messages if m.get("role") == "system"]
+    tokens = REPLY_OVERHEAD + sum(message_tokens(m, model) for m in system)
+
+    recent = []
+    for message in reversed(messages):
+        if message.get("role") == "system":
+            continue
+        cost = message_tokens(message, model)
+        if recent and tokens + cost > budget:
+            break
+        recent.append(message)
+        tokens += cost
+    recent.reverse()
+
+    # Don't open the window with a reply whose question was dropped
+    while len(recent) > 1 and recent[0].get("role") == "assistant":
+        tokens -= message_tokens(recent.pop(0), model)
+
+    return system + recent, tokens
@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import asynccontextmanager, contextmanager
+
+import openai
+
+import metrics
+import resilience
+from context_window import build_context, context_budget, message_tokens
+
+# Errors worth another attempt, anything else is raised straight away
+RETRYABLE_ERRORS = (
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+# A request ready to send: the chosen model and the messages that fit its budget
+Prompt = namedtuple("Prompt", "model messages tokens budget")
+
+
+class Slots:
+    """A counting semaphore shared by threads and any number of event loops.
+
+    asyncio.Semaphore belongs to one loop, but sync mode runs every update
+    on its own loop and webhook workers each have theirs, so the limit has
+    to live outside them. Slots are handed to waiters in arrival order.
+    """
+
+    def __init__(self, count):
+        self.lock = threading.Lock()
+        self.free = count
+        # threading.Event for threads, (loop, future) for coroutines
+        self.waiters = deque()
+
+    def acquire(self):
+        with self.lock:
+            if self.free > 0 and not self.waiters:
+                self.free -= 1
+                return
+            event = threading.Event()
+            self.waiters.append(event)
+        event.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.free > 0 and not self.waiters:
+                self.free -= 1
+                return
+            waiter = (loop, loop.create_future())
+            self.waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self.lock:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                    raise
+            # The slot was already handed over. _wake() passes it on if it
+            # finds the future cancelled, otherwise it is ours to give back.
+            if not waiter[1].cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self.lock:
+            while self.waiters:
+                waiter = self.waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                loop, future = waiter
+                try:
+                    loop.call_soon_threadsafe(self._wake, future)
+                    return
+                except RuntimeError:
+                    # Its loop is closed, try the next waiter
+                    continue
+            self.free += 1
+
+    def _wake(self, future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+class ChatEngine:
+    """The one code path for OpenAI chat completions used by all entry points.
+
+    prepare() picks the model and trims the messages to its context budget.
+    complete(), acomplete() and astream() then run the request with a
+    timeout, retry retryable errors with jittered exponential backoff and
+    hold one of max_concurrency slots while the request is in flight.
+    Every attempt goes through the "openai.chat" circuit breaker, so while
+    OpenAI keeps failing requests raise CircuitOpenError without waiting.
+    When fast_model is set, prompts whose latest message has at most
+    fast_max_tokens tokens go to fast_model and the rest to default_model.
+    """
+
+    def __init__(self, default_model, fast_model=None, fast_max_tokens=200, timeout=60, max_retries=3,
+                 backoff=0.5, max_backoff=8.0, max_concurrency=32, budgets=None, reply_reserve=1024):
+        self.default_model = default_model
+        self.fast_model = fast_model
+        self.fast_max_tokens = fast_max_tokens
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_concurrency = max_concurrency
+        self.budgets = budgets or {}
+        self.reply_reserve = reply_reserve
+        self.lock = threading.Lock()
+        # One limit for the whole process, whichever thread or loop the request comes from
+        self.slots = Slots(max_concurrency)
+        self.waiting = 0
+        self.active = 0
+
+    @classmethod
+    def from_config(cls, config, default_model):
+        return cls(
+            default_model,
+            fast_model=config.get('FAST_MODEL'),
+            fast_max_tokens=config.get('FAST_MODEL_MAX_TOKENS', 200),
+            timeout=config.get('REQUEST_TIMEOUT', 60),
+            max_retries=config.get('MAX_RETRIES', 3),
+            max_concurrency=config.get('MAX_CONCURRENT_REQUESTS', 32),
+            budgets=config.get('CONTEXT_BUDGETS', {}),
+            reply_reserve=config.get('REPLY_RESERVE', 1024),
+        )
+
+    def choose_model(self, messages):
+        if self.fast_model is None or not messages:
+            return self.default_model
+        latest = message_tokens(messages[-1], self.fast_model)
+        return self.fast_model if latest <= self.fast_max_tokens else self.default_model
+
+    def prepare(self, messages, model=None, budget=None):
+        # budget can only narrow the model's own context budget
+        model = model or self.choose_model(messages)
+        limit = context_budget(model, self.budgets, self.reply_reserve)
+        budget = min(budget, limit) if budget else limit
+        fitted, tokens = build_context(messages, model, budget)
+        return Prompt(model, fitted, tokens, budget)
+
+    def _delay(self, attempt):
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def _record(self, prompt, started, attempts):
+        metrics.observe(f"engine.latency.{prompt.model}", time.perf_counter() - started)
+        metrics.observe("engine.prompt_tokens", prompt.tokens)
+        metrics.observe("engine.attempts", attempts)
+
+    def _queued(self, change):
+        with self.lock:
+            self.waiting += change
+            if change > 0:
+                metrics.observe("engine.queue_depth", self.waiting)
+
+    def _running(self, change):
+        with self.lock:
+            self.active += change
+
+    @contextmanager
+    def _slot(self):
+        self._queued(1)
+        try:
+            self.slots.acquire()
+        finally:
+            self._queued(-1)
+        self._running(1)
+        try:
+            yield
+        finally:
+            self._running(-1)
+            self.slots.release()
+
+    @asynccontextmanager
+    async def _async_slot(self):
+        self._queued(1)
+        try:
+            await self.slots.acquire_async()
+        finally:
+            self._queued(-1)
+        self._running(1)
+        try:
+            yield
+        finally:
+            self._running(-1)
+            self.slots.release()
+
+    def complete(self, messages, model=None, **params):
+        # Returns (reply text, prompt)
+        prompt = self.prepare(messages, model)
+        started = time.perf_counter()
+        with self._slot():
+            for attempt in range(self.max_retries + 1):
+                try:
+                    with resilience.breaker("openai.chat").guard():
+                        response = openai.ChatCompletion.create(
+                            model=prompt.model, messages=prompt.messages, request_timeout=self.timeout, **params)
+                    break
+                except RETRYABLE_ERRORS as e:
+                    if attempt == self.max_retries:
+                        raise
+                    logging.warning(f"OpenAI request failed ({e}), retrying")
+                    time.sleep(self._delay(attempt))
+        self._record(prompt, started, attempt + 1)
+        metrics.observe("engine.completion_tokens", response['usage']['completion_tokens'])
+        return response['choices'][0]['message']['content'].strip(), prompt
+
+    async def acomplete(self, messages, model=None, **params):
+        # Returns (reply text, prompt)
+        prompt = self.prepare(messages, model)
+        started = time.perf_counter()
+        async with self._async_slot():
+            for attempt in range(self.max_retries + 1):
+                try:
+                    with resilience.breaker("openai.chat").guard():
+                        response = await openai.ChatCompletion.acreate(
+                            model=prompt.model, messages=prompt.messages, request_timeout=self.timeout, **params)
+                    break
+                except RETRYABLE_ERRORS as e:
+                    if attempt == self.max_retries:
+                        raise
+                    logging.warning(f"OpenAI request failed ({e}), retrying")
+                    await asyncio.sleep(self._delay(attempt))
+        self._record(prompt, started, attempt + 1)
+        metrics.observe("engine.completion_tokens", response['usage']['completion_tokens'])
+        return response['choices'][0]['message']['content'].strip(), prompt
+
+    async def astream(self, messages, model=None, **params):
+        # Yields pieces of the reply, retrying only until the first piece arrived
+        prompt = self.prepare(messages, model)
+        started = time.perf_counter()
+        async with self._async_slot():
+            for attempt in range(self.max_retries + 1):
+                received = False
+                try:
+                    with resilience.breaker("openai.chat").guard():
+                        async for chunk in await openai.ChatCompletion.acreate(
+                                model=prompt.model, messages=prompt.messages, request_timeout=self.timeout,
+                                stream=True, **params):
+                            delta = chunk['choices'][0]['delta'].get('content')
+                            if delta:
+                                if not received:
+                                    metrics.observe("engine.first_token", time.perf_counter() - started)
+                                received = True
+                                yield delta
+                    break
+                except RETRYABLE_ERRORS as e:
+                    if received or attempt == self.max_retries:
+                        raise
+                    logging.warning(f"OpenAI stream failed ({e}), retrying")
+                    await asyncio.sleep(self._delay(attempt))
+        self._record(prompt, started, attempt + 1)
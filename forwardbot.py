@@ -1,50 +1,71 @@
 import os
-import json
 import html
-import openai
+import signal
+import atexit
+import threading
+import time
+import clients
+import metrics
+import state
+from config_store import ConfigStore
+from engine import ChatEngine
+from language import LanguageDetector, is_chinese as is_chinese_code
+from send_queue import SendScheduler
+from streaming import MESSAGE_LIMIT, split_message
+from translator import TranslationBatcher
 from telegram import Update
 from telegram.ext import Updater, MessageHandler, Filters, CommandHandler
-from langdetect import detect
-from google.cloud import translate_v2 as translate
-
-# Global variable to store the configuration data
-data = {}
 
 CONFIG_FILE = '.forward.json'
 
+# Global store for the configuration data, written back only when it changes
+data = ConfigStore(CONFIG_FILE)
+
+# Groups translations of messages arriving close together, created in main()
+batcher = None
+engine = None
+# Rate-limited outbound queue to the destination chat, created in main()
+send_queue = None
+
 # Load Configuration
 def load_config():
-    with open(CONFIG_FILE, 'r') as file:
-        global data
-        data = json.load(file)
+    data.load()
+    # With a shared STATE_BACKEND the chats changed at runtime live there, not in the file
+    if data.get('STATE_BACKEND', "memory") != "memory" and data.backend is None:
+        data.backend = state.open_backend(data)
+        data.load()
+
+# Detect if text is Chinese, simplified or traditional, without a network call
+language_detector = LanguageDetector()
 
-# Detect if text is Chinese
 def is_chinese(text):
-    try:
-        return detect(text) == 'zh-cn'
-    except:
-        return False
+    return is_chinese_code(language_detector.detect(text))
 
 # Translate text to Chinese using ChatGPT
 def translate_to_chinese(text):
-    response = openai.Completion.create(
-      model="gpt-4-0613",
-      prompt=f"You are a translator familiar with Internet technology and crypto technology. Please translate the following English text to Chinese: \"{text}\"",
-      max_tokens=1500
-    )
-    return response.choices[0].text.strip()
+    translated, _ = engine.complete([
+        {"role": "system", "content": "You are a translator familiar with Internet technology and crypto technology."},
+        {"role": "user", "content": f"Please translate the following English text to Chinese: \"{text}\""},
+    ], max_tokens=1500)
+    return translated
 
 def translate_to_chineseViaGoogle(text):
-    client = translate.Client()
-    result = client.translate(text, target_language="zh-CN")
+    client = clients.translate_client()
+    with clients.timed("google.translate"):
+        result = client.translate(text, target_language="zh-CN")
     return result.get('translatedText')
 
+def translate_many_to_chineseViaGoogle(texts):
+    # One request for the whole batch
+    client = clients.translate_client()
+    with clients.timed("google.translate"):
+        results = client.translate(texts, target_language="zh-CN")
+    return [result.get('translatedText') for result in results]
+
 # Command to set the current chat as the destination chat
 def sethost(update: Update, context):
     chat_id = update.message.chat_id
     data['DESTINATION_CHAT_ID'] = chat_id
-    with open(CONFIG_FILE, 'w') as file:
-        json.dump(data, file)
     update.message.reply_text("This chat has been set as the destination chat.")
 
 # Command to list all source chats
@@ -57,67 +78,62 @@ def list_chats(update: Update, context):
 # Command to pause forwarding from a specific chat
 def pause(update: Update, context):
     chat_id = int(context.args[0])
-    if 'PAUSED_CHATS' not in data:
-        data['PAUSED_CHATS'] = []
-    data['PAUSED_CHATS'].append(chat_id)
-    data['PAUSED_CHATS'] = list(set(data['PAUSED_CHATS']))  # Ensure uniqueness
-    with open(CONFIG_FILE, 'w') as file:
-        json.dump(data, file)
+    data.pause([chat_id])
     update.message.reply_text(f"Paused forwarding messages from chat {chat_id}.")
 
 # Command to resume forwarding from a specific chat
 def resume(update: Update, context):
     chat_id = int(context.args[0])
-    if 'PAUSED_CHATS' in data and chat_id in data['PAUSED_CHATS']:
-        data['PAUSED_CHATS'].remove(chat_id)
-        with open(CONFIG_FILE, 'w') as file:
-            json.dump(data, file)
+    if data.resume([chat_id]):
         update.message.reply_text(f"Resumed forwarding messages from chat {chat_id}.")
     else:
         update.message.reply_text(f"Chat {chat_id} was not paused.")
 
 # Command to pause forwarding from all chats
 def pauseall(update: Update, context):
-    data['PAUSED_CHATS'] = list(data.get('SOURCE_CHATS', {}).keys())
-    with open(CONFIG_FILE, 'w') as file:
-        json.dump(data, file)
+    data.pause(int(chat_id) for chat_id in data.get('SOURCE_CHATS', {}))
     update.message.reply_text("Paused forwarding messages from all chats.")
 
 # Command to resume forwarding from all chats
 def resumeall(update: Update, context):
-    data['PAUSED_CHATS'] = []
-    with open(CONFIG_FILE, 'w') as file:
-        json.dump(data, file)
+    data.resume(list(data.paused))
     update.message.reply_text("Resumed forwarding messages from all chats.")
 
 
 def forward_message(update: Update, context):
     message = update.message
     chat_id = message.chat_id
+
+    # Check if the chat is paused before spending anything on the message
+    if data.is_paused(chat_id):
+        return
+    received = time.perf_counter()
+
     chat_name = html.escape(message.chat.title)
     user_name = html.escape(message.from_user.first_name or message.from_user.username)
     message_text = html.escape(message.text)
 
-    
-    # If the message is not in Chinese, translate it
-    if not is_chinese(message_text):
-        translated_text = translate_to_chineseViaGoogle(message_text)
-        message_text = f"{message_text}\n\n翻译: {translated_text}"
-    
-    formatted_message = f"<b>{chat_name}</b> - <i>{user_name}</i>:\n\n{message_text}"
-    # Check if the chat is paused
-    if chat_id in data.get('PAUSED_CHATS', []):
-        return
+    def send(translated_text):
+        header = f"<b>{chat_name}</b> - <i>{user_name}</i>:\n\n"
+        text = message_text
+        if translated_text:
+            text = f"{message_text}\n\n翻译: {translated_text}"
 
-    # Forward the message
-    context.bot.send_message(chat_id=data['DESTINATION_CHAT_ID'], text=formatted_message, parse_mode="HTML")
+        # Forward the message, too long for one it goes out in parts that each
+        # carry the header. This blocks while the send queue is full.
+        for part in split_message(text, MESSAGE_LIMIT - len(header)):
+            send_queue.submit(data['DESTINATION_CHAT_ID'], header + part, parse_mode="HTML")
+        metrics.observe("forward.queued_after", time.perf_counter() - received)
+
+    # If the message is not in Chinese, translate it. Every message goes
+    # through the batcher so forwards keep their order, this blocks while
+    # its queue is full.
+    with metrics.timer("forward.detect_language"):
+        chinese = is_chinese(message_text)
+    batcher.submit(None if chinese else message_text, send)
 
-    # Save the source chat ID and name to the config
-    if 'SOURCE_CHATS' not in data:
-        data['SOURCE_CHATS'] = {}
-    data['SOURCE_CHATS'][str(chat_id)] = chat_name
-    with open(CONFIG_FILE, 'w') as file:
-        json.dump(data, file)
+    # Save the source chat ID and name to the config, only written when new
+    data.set_source_chat(str(chat_id), chat_name)
 
 
 def forward_message_v1(update: Update, context):
@@ -133,27 +149,50 @@ def forward_message_v1(update: Update, context):
         message_text = f"{message_text}\n\n翻译: {translated_text}"
 
     # Check if the chat is paused
-    if chat_id in data.get('PAUSED_CHATS', []):
+    if data.is_paused(chat_id):
         return
 
     # Forward the message
     context.bot.send_message(chat_id=data['DESTINATION_CHAT_ID'], text=message_text)
 
-    # Save the source chat ID and name to the config
-    if 'SOURCE_CHATS' not in data:
-        data['SOURCE_CHATS'] = {}
-    data['SOURCE_CHATS'][str(chat_id)] = chat_name
-    with open(CONFIG_FILE, 'w') as file:
-        json.dump(data, file)
+    # Save the source chat ID and name to the config, only written when new
+    data.set_source_chat(str(chat_id), chat_name)
 
 def main():
     load_config()
+    atexit.register(data.flush)
+    # Reload the config on SIGHUP, off the signal handler
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=data.reload).start())
 
     updater = Updater(token=data['TELEGRAM_BOT_TOKEN'])
     dp = updater.dispatcher
 
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = data['GOOGLE_CLOUD_KEY_FILE']
-    openai.api_key = data['OPENAI_API_KEY']
+    clients.configure_openai(data['OPENAI_API_KEY'])
+
+    global batcher, engine, send_queue
+    engine = ChatEngine.from_config(data, "gpt-4-0613")
+    send_queue = SendScheduler(
+        updater.bot,
+        chat_rate=data.get('SEND_CHAT_RATE', 1 / 3),
+        global_rate=data.get('SEND_GLOBAL_RATE', 30),
+        max_queue=data.get('SEND_QUEUE_SIZE', 1000),
+        coalesce=data.get('COALESCE_MESSAGES', False),
+    )
+    batcher = TranslationBatcher(
+        translate_many_to_chineseViaGoogle,
+        window=data.get('TRANSLATION_BATCH_WINDOW', 0.05),
+        cache_ttl=data.get('TRANSLATION_CACHE_TTL', 3600),
+        max_queue=data.get('TRANSLATION_QUEUE_SIZE', 1000),
+    )
+
+    # Local /metrics (Prometheus) and /profile endpoint
+    if data.get('METRICS_PORT'):
+        metrics.gauge("forward.send_queue_depth", send_queue.depth)
+        metrics.gauge("forward.translation_queue_depth", batcher.queue.qsize)
+        metrics.gauge("forward.sent", lambda: send_queue.sent)
+        metrics.gauge("forward.dropped", lambda: send_queue.dropped)
+        metrics.serve(data['METRICS_PORT'])
 
     # Register the command handlers
     dp.add_handler(CommandHandler("sethost", sethost))
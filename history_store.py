@@ -0,0 +1,606 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+# Names of saved chats: letters, digits, "_" and "-", so they never form a path
+VALID_NAME = re.compile(r"[^\W][\w-]{0,63}")
+PREVIEW_LENGTH = 100
+
+
+def is_valid_name(name):
+    return VALID_NAME.fullmatch(name) is not None
+
+
+def _fingerprint(messages):
+    # (length, hash of the last message) identifies what a caller last read or saved
+    return len(messages), hash(json.dumps(messages[-1], sort_keys=True)) if messages else None
+
+
+class HistoryStore:
+    """Append-only, write-behind storage for chat histories.
+
+    Every conversation is a named ref in user_data/{user_id}/{user_id}.refs.json
+    pointing at a log file and a length. Logs hold one JSON message per line
+    and are only ever appended to, so a ref can share a log with other refs:
+    saving a chat under a new name just records the current log and length.
+    A log may start with a header line naming a parent log, which lets a ref
+    branch off a shorter ref without copying it. New lines are buffered and
+    written with one fsync per batch by a background thread, which also
+    flattens long parent chains and removes unreferenced logs. The thread
+    writes and fsyncs without holding the store's lock, so reads and saves
+    only wait for it when they touch a log it is writing.
+
+    Each ref can also have a rolling summary of its older turns, kept in
+    {user_id}.summaries.json next to the refs and copied by snapshot().
+    Refs written by snapshot() are described in {user_id}.catalog.json
+    (turns, size, preview of the last message, timestamps), so saved chats
+    can be listed and searched without opening their logs.
+    """
+
+    def __init__(self, root, flush_interval=1.0, batch_size=64, max_chain=4, compact_interval=60.0):
+        self.root = root
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_chain = max_chain
+        self.compact_interval = compact_interval
+        self.lock = threading.RLock()
+        self.wakeup = threading.Condition(self.lock)
+        self.refs = {}
+        self.summaries = {}
+        self.catalogs = {}
+        # (user_id, log) -> {"parent", "parent_length", "count", "pending", "io"},
+        # "io" is held while the log's lines are written
+        self.logs = {}
+        # (user_id, name) -> _fingerprint() of what the caller last read or saved
+        self.known = {}
+        self.dirs = set()
+        # Users whose legacy files were all imported
+        self.imported = set()
+        self.compact_users = set()
+        self.pending_count = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="history-store", daemon=True)
+        self.thread.start()
+
+    # Paths
+
+    def _user_dir(self, user_id):
+        path = f"{self.root}/{user_id}/"
+        if user_id not in self.dirs:
+            os.makedirs(path, exist_ok=True)
+            self.dirs.add(user_id)
+        return path
+
+    def _log_path(self, user_id, log):
+        return f"{self._user_dir(user_id)}{user_id}_{log}.log"
+
+    def _json_path(self, user_id, suffix):
+        # {user_id}.refs.json, .summaries.json or .catalog.json
+        return f"{self.root}/{user_id}/{user_id}.{suffix}.json"
+
+    def _legacy_path(self, user_id, name):
+        return f"{self.root}/{user_id}/{user_id}_{name}.json"
+
+    # Refs
+
+    def _load_json(self, user_id, suffix, cache):
+        # One of the user's JSON files, read on first use and kept in cache
+        if user_id not in cache:
+            path = self._json_path(user_id, suffix)
+            value = {}
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    value = json.load(f)
+            cache[user_id] = value
+        return cache[user_id]
+
+    def _write_json(self, user_id, suffix, cache):
+        # Replace the file atomically with what cache holds for the user
+        self._user_dir(user_id)
+        path = self._json_path(user_id, suffix)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache[user_id], f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _user_refs(self, user_id):
+        return self._load_json(user_id, "refs", self.refs)
+
+    def _write_refs(self, user_id):
+        self._write_json(user_id, "refs", self.refs)
+
+    def _user_summaries(self, user_id):
+        return self._load_json(user_id, "summaries", self.summaries)
+
+    def _write_summaries(self, user_id):
+        self._write_json(user_id, "summaries", self.summaries)
+
+    def _user_catalog(self, user_id):
+        return self._load_json(user_id, "catalog", self.catalogs)
+
+    def _write_catalog(self, user_id):
+        self._write_json(user_id, "catalog", self.catalogs)
+
+    def _import_legacy(self, user_id):
+        # Import every old whole-file history of the user, once per user
+        if user_id in self.imported:
+            return
+        prefix, suffix = f"{user_id}_", ".json"
+        for file_name in os.listdir(self._user_dir(user_id)):
+            if file_name.startswith(prefix) and file_name.endswith(suffix):
+                self._ref(user_id, file_name[len(prefix):-len(suffix)])
+        self.imported.add(user_id)
+
+    def _describe(self, user_id, name, created=None):
+        # Catalog entry of a ref, reading only its last message
+        log, length = self._resolve(user_id, name)
+        tail = self._read_tail(user_id, log, length, 1)
+        now = time.time()
+        return {
+            "turns": length,
+            "bytes": self._ref_bytes(user_id, log, length),
+            "preview": tail[0].get("content", "")[:PREVIEW_LENGTH] if tail else "",
+            "created": created or now,
+            "updated": now,
+        }
+
+    def _ref(self, user_id, name):
+        refs = self._user_refs(user_id)
+        if name not in refs and is_valid_name(name) and os.path.exists(self._legacy_path(user_id, name)):
+            # Import a history written by the old whole-file format
+            with open(self._legacy_path(user_id, name), "r") as f:
+                messages = json.load(f)
+            log = self._new_log(user_id, messages)
+            self._flush_log(user_id, log)
+            refs[name] = {"log": log, "length": None}
+            self._write_refs(user_id)
+        return refs.get(name)
+
+    # Logs
+
+    def _new_log(self, user_id, messages, parent=None, parent_length=0):
+        log = uuid.uuid4().hex[:12]
+        info = {"parent": parent, "parent_length": parent_length, "count": 0, "pending": [], "io": threading.Lock()}
+        if parent is not None:
+            info["pending"].append({"parent": parent, "length": parent_length})
+        self.logs[(user_id, log)] = info
+        self._append(user_id, log, messages)
+        return log
+
+    def _log_info(self, user_id, log):
+        key = (user_id, log)
+        if key not in self.logs:
+            header, count = self._count_log(user_id, log)
+            self.logs[key] = {
+                "parent": header.get("parent"),
+                "parent_length": header.get("length", 0),
+                "count": count,
+                "pending": [],
+                "io": threading.Lock(),
+            }
+        # Used again, so keep it after all
+        self.logs[key].pop("forget", None)
+        return self.logs[key]
+
+    def _scan_log(self, user_id, log):
+        # Read a log back, dropping a torn trailing line left by a crash
+        path = self._log_path(user_id, log)
+        header, records = {}, []
+        if not os.path.exists(path):
+            return header, records
+        good = 0
+        with open(path, "rb") as f:
+            data = f.read()
+        for line in data.splitlines(keepends=True):
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("incomplete line")
+                record = json.loads(line)
+            except ValueError:
+                logging.warning(f"Truncating damaged history log {path} at byte {good}")
+                with open(path, "r+b") as f:
+                    f.truncate(good)
+                break
+            good += len(line)
+            if not records and not header and "parent" in record and "role" not in record:
+                header = record
+            else:
+                records.append(record)
+        return header, records
+
+    def _count_log(self, user_id, log):
+        # The header and number of messages of a log, counting its lines
+        # without parsing them. A torn trailing line is cut off as in _scan_log.
+        path = self._log_path(user_id, log)
+        if not os.path.exists(path):
+            return {}, 0
+        with open(path, "rb") as f:
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            logging.warning(f"Truncating damaged history log {path} at byte {end}")
+            with open(path, "r+b") as f:
+                f.truncate(end)
+        count = data.count(b"\n", 0, end)
+        if not count:
+            return {}, 0
+        try:
+            first = json.loads(data[:data.index(b"\n")])
+        except ValueError:
+            header, records = self._scan_log(user_id, log)
+            return header, len(records)
+        if "parent" in first and "role" not in first:
+            return first, count - 1
+        return {}, count
+
+    def _log_length(self, user_id, log):
+        info = self._log_info(user_id, log)
+        return info["parent_length"] + info["count"]
+
+    def _read_log(self, user_id, log, length=None):
+        info = self._log_info(user_id, log)
+        self._flush_log(user_id, log)
+        _, records = self._scan_log(user_id, log)
+        # A damaged line in the middle is only found by parsing, the log ends there
+        info["count"] = len(records)
+        messages = []
+        if info["parent"] is not None:
+            messages = self._read_log(user_id, info["parent"], info["parent_length"])
+        messages.extend(records)
+        return messages if length is None else messages[:length]
+
+    def _tail_lines(self, user_id, log, skip, count):
+        # The count lines before the last skip lines of a log, read backwards
+        # from the end of the file so long logs are not read in full
+        path = self._log_path(user_id, log)
+        if not os.path.exists(path):
+            return []
+        wanted = skip + count
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            data = b""
+            while position > 0 and data.count(b"\n") <= wanted:
+                step = min(64 * 1024, position)
+                position -= step
+                f.seek(position)
+                data = f.read(step) + data
+        lines = data.split(b"\n")[:-1]
+        if position > 0:
+            # The first piece may be the end of an earlier line
+            lines = lines[1:]
+        records = [json.loads(line) for line in lines[max(0, len(lines) - wanted):len(lines) - skip]]
+        if position == 0 and records and "parent" in records[0] and "role" not in records[0] and len(lines) <= wanted:
+            records = records[1:]
+        return records
+
+    def _read_tail(self, user_id, log, length, count):
+        messages = []
+        while log is not None and length > 0 and len(messages) < count:
+            self._flush_log(user_id, log)
+            info = self._log_info(user_id, log)
+            own = length - info["parent_length"]
+            if own > 0:
+                needed = min(count - len(messages), own)
+                messages[:0] = self._tail_lines(user_id, log, info["count"] - own, needed)
+            log, length = info["parent"], min(length, info["parent_length"])
+        return messages[-count:] if count else []
+
+    def _ref_bytes(self, user_id, log, length):
+        # Approximate size of a ref's messages: its share of every log in its chain
+        total = 0
+        while log is not None and length > 0:
+            info = self._log_info(user_id, log)
+            own = length - info["parent_length"]
+            if own > 0 and info["count"]:
+                self._flush_log(user_id, log)
+                total += os.path.getsize(self._log_path(user_id, log)) * own // info["count"]
+            log, length = info["parent"], min(length, info["parent_length"])
+        return total
+
+    def _chain_depth(self, user_id, log):
+        depth = 0
+        while log is not None:
+            depth += 1
+            log = self._log_info(user_id, log)["parent"]
+        return depth
+
+    def _append(self, user_id, log, messages):
+        info = self._log_info(user_id, log)
+        info["pending"].extend(messages)
+        info["count"] += len(messages)
+        self.pending_count += len(messages)
+        if self.pending_count >= self.batch_size:
+            self.wakeup.notify()
+
+    def _write_lines(self, path, records):
+        with open(path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _take_pending(self, info):
+        # Called with the lock held, the caller writes the records and releases info["io"]
+        info["io"].acquire()
+        records, info["pending"] = info["pending"], []
+        self.pending_count -= len([r for r in records if "role" in r])
+        return records
+
+    def _restore_pending(self, info, records):
+        # A write failed, the records are written with the next batch instead.
+        # Called with info["io"] held, so the pending list can't be swapped
+        # meanwhile, and save() only appends to it, with one list operation.
+        # pending_count only decides when to wake the writer early.
+        info["pending"][:0] = records
+        self.pending_count += len([r for r in records if "role" in r])
+
+    def _flush_log(self, user_id, log):
+        # Also waits for a background write of this log, so the file is complete afterwards
+        info = self.logs.get((user_id, log))
+        if not info:
+            return
+        records = self._take_pending(info)
+        try:
+            if records:
+                self._write_lines(self._log_path(user_id, log), records)
+        except Exception:
+            self._restore_pending(info, records)
+            raise
+        finally:
+            info["io"].release()
+
+    def _resolve(self, user_id, name):
+        ref = self._ref(user_id, name)
+        if ref is None:
+            return None, 0
+        length = self._log_length(user_id, ref["log"])
+        if ref["length"] is not None:
+            length = min(ref["length"], length)
+        return ref["log"], length
+
+    # Public API
+
+    def exists(self, user_id, name="default"):
+        with self.lock:
+            return self._ref(user_id, name) is not None
+
+    def read(self, user_id, name="default"):
+        # Returns the messages of a ref, or None if it does not exist
+        with self.lock:
+            log, length = self._resolve(user_id, name)
+            if log is None:
+                return None
+            messages = self._read_log(user_id, log, length)
+            self.known[(user_id, name)] = _fingerprint(messages)
+            return messages
+
+    def save(self, user_id, messages, name="default"):
+        # Append what is new since the last read/save, or start a fresh log
+        with self.lock:
+            refs = self._user_refs(user_id)
+            ref = self._ref(user_id, name)
+            known = self.known.get((user_id, name))
+            extends = (
+                ref is not None and known is not None and len(messages) >= known[0]
+                and _fingerprint(messages[:known[0]]) == known
+            )
+            if extends:
+                new_messages = messages[known[0]:]
+                log, length = self._resolve(user_id, name)
+                shared_tip = any(
+                    other is not ref and other["log"] == log and other["length"] is None
+                    for other in refs.values()
+                )
+                if length == self._log_length(user_id, log) and not shared_tip:
+                    self._append(user_id, log, new_messages)
+                    if ref["length"] is not None:
+                        ref["length"] = None
+                        self._write_refs(user_id)
+                elif new_messages:
+                    # Branch off a shared prefix without copying it
+                    self._flush_log(user_id, log)
+                    refs[name] = {"log": self._new_log(user_id, new_messages, log, length), "length": None}
+                    self._write_refs(user_id)
+                    if self._chain_depth(user_id, refs[name]["log"]) > self.max_chain:
+                        self.compact_users.add(user_id)
+            else:
+                refs[name] = {"log": self._new_log(user_id, list(messages)), "length": None}
+                self._flush_log(user_id, refs[name]["log"])
+                self._write_refs(user_id)
+                if ref is not None:
+                    self.compact_users.add(user_id)
+                    # The summary was of the old log, it must not match the new one by chance
+                    summaries = self._user_summaries(user_id)
+                    if summaries.pop(name, None) is not None:
+                        self._write_summaries(user_id)
+            self.known[(user_id, name)] = _fingerprint(messages)
+
+    def snapshot(self, user_id, source, target):
+        # Point target at the current contents of source, no messages are copied
+        with self.lock:
+            log, length = self._resolve(user_id, source)
+            if log is None:
+                return False
+            self._flush_log(user_id, log)
+            refs = self._user_refs(user_id)
+            replaced = refs.get(target)
+            refs[target] = {"log": log, "length": length}
+            self._write_refs(user_id)
+            self.known.pop((user_id, target), None)
+            if replaced is not None:
+                self.compact_users.add(user_id)
+            catalog = self._user_catalog(user_id)
+            if target != "default":
+                created = catalog.get(target, {}).get("created")
+                catalog[target] = self._describe(user_id, target, created)
+                self._write_catalog(user_id)
+            summaries = self._user_summaries(user_id)
+            if summaries.get(source) != summaries.get(target):
+                if source in summaries:
+                    summaries[target] = summaries[source]
+                else:
+                    del summaries[target]
+                self._write_summaries(user_id)
+            return True
+
+    def read_tail(self, user_id, name="default", count=1):
+        # The last count messages of a ref, None if it does not exist
+        with self.lock:
+            log, length = self._resolve(user_id, name)
+            if log is None:
+                return None
+            return self._read_tail(user_id, log, length, count)
+
+    def catalog(self, user_id):
+        # name -> {"turns", "bytes", "preview", "created", "updated"} of the saved chats
+        with self.lock:
+            self._import_legacy(user_id)
+            catalog = self._user_catalog(user_id)
+            missing = [name for name in self._user_refs(user_id) if name != "default" and name not in catalog]
+            for name in missing:
+                # Saved before the catalog existed
+                catalog[name] = self._describe(user_id, name)
+            if missing:
+                self._write_catalog(user_id)
+            return {name: dict(entry) for name, entry in catalog.items()}
+
+    def search(self, user_id, text):
+        # Saved chats whose name or last message contains text, newest first
+        text = text.lower()
+        matches = [
+            (name, entry) for name, entry in self.catalog(user_id).items()
+            if text in name.lower() or text in entry["preview"].lower()
+        ]
+        return sorted(matches, key=lambda match: match[1]["updated"], reverse=True)
+
+    def read_summary(self, user_id, name="default"):
+        # {"text", "covers", "last"}: a summary of the first covers messages,
+        # the last of which was last. None if the ref has no summary.
+        with self.lock:
+            return self._user_summaries(user_id).get(name)
+
+    def save_summary(self, user_id, summary, name="default"):
+        with self.lock:
+            self._user_summaries(user_id)[name] = summary
+            self._write_summaries(user_id)
+
+    def flush(self):
+        # The pending lines are taken under the lock and written outside it
+        with self.lock:
+            batches = [
+                (key, self._log_path(*key), info, self._take_pending(info))
+                for key, info in self.logs.items() if info["pending"]
+            ]
+        self._write_batches(batches)
+
+    def sync(self, user_id, name="default"):
+        # Write a ref's pending lines now, e.g. before a journal records the turn as stored
+        with self.lock:
+            ref = self._ref(user_id, name)
+            key = (user_id, ref["log"]) if ref is not None else None
+            info = self.logs.get(key)
+            batches = [(key, self._log_path(*key), info, self._take_pending(info))] if info and info["pending"] else []
+        self._write_batches(batches)
+
+    def _write_batches(self, batches):
+        error = None
+        for key, path, info, records in batches:
+            try:
+                self._write_lines(path, records)
+            except Exception as e:
+                # Not under self.lock: a reader may hold it while it waits for io
+                self._restore_pending(info, records)
+                error = e
+            finally:
+                info["io"].release()
+        with self.lock:
+            for key, _, info, _ in batches:
+                if info.get("forget") and not info["pending"] and self.logs.get(key) is info:
+                    del self.logs[key]
+        if error is not None:
+            raise error
+
+    def forget(self, user_id):
+        # Drop what is kept in memory for a user, e.g. when the chat cache evicts
+        # them. Logs with lines still to write are dropped by flush() afterwards.
+        with self.lock:
+            for cache in (self.refs, self.summaries, self.catalogs):
+                cache.pop(user_id, None)
+            self.dirs.discard(user_id)
+            self.imported.discard(user_id)
+            for key in [key for key in self.known if key[0] == user_id]:
+                del self.known[key]
+            for key in [key for key in self.logs if key[0] == user_id]:
+                info = self.logs[key]
+                if info["pending"] or info["io"].locked():
+                    info["forget"] = True
+                else:
+                    del self.logs[key]
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.thread.join()
+        self.flush()
+
+    # Background work
+
+    def _run(self):
+        last_compaction = time.monotonic()
+        while True:
+            with self.lock:
+                if self.closed:
+                    break
+                self.wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+                if time.monotonic() - last_compaction >= self.compact_interval:
+                    last_compaction = time.monotonic()
+                    with self.lock:
+                        users = list(self.compact_users)
+                        self.compact_users.clear()
+                    # One user at a time, so other users only wait for one compaction
+                    for user_id in users:
+                        with self.lock:
+                            self._compact(user_id)
+            except Exception as e:
+                logging.error(f"History store background work failed: {e}")
+
+    def _compact(self, user_id):
+        refs = self._user_refs(user_id)
+        # Flatten refs whose parent chain has grown too long
+        for name, ref in refs.items():
+            if self._chain_depth(user_id, ref["log"]) > self.max_chain:
+                log, length = self._resolve(user_id, name)
+                messages = self._read_log(user_id, log, length)
+                new_log = self._new_log(user_id, messages)
+                self._flush_log(user_id, new_log)
+                refs[name] = {"log": new_log, "length": None}
+        self._write_refs(user_id)
+
+        # Drop logs no ref can reach any more
+        reachable = set()
+        for ref in refs.values():
+            log = ref["log"]
+            while log is not None and log not in reachable:
+                reachable.add(log)
+                log = self._log_info(user_id, log)["parent"]
+        prefix, suffix = f"{user_id}_", ".log"
+        for file_name in os.listdir(self._user_dir(user_id)):
+            if file_name.startswith(prefix) and file_name.endswith(suffix):
+                log = file_name[len(prefix):-len(suffix)]
+                if log not in reachable:
+                    info = self.logs.pop((user_id, log), None)
+                    if info is not None:
+                        # Wait for a write still in flight
+                        with info["io"]:
+                            pass
+                    os.remove(self._user_dir(user_id) + file_name)
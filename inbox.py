@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import threading
+
+
+class Inbox:
+    """Durable record of the updates accepted but not finished yet.
+
+    A journal of JSON lines: "add" when an update is accepted, "commit"
+    once its reply was stored or shown, "done" when nothing is left to do
+    for it.
+    Lines are written straight away and fsynced in batches by a background
+    thread every flush_interval seconds. After a restart pending() returns
+    the updates that never got their "done", in arrival order. The journal
+    is rewritten with only those once it holds more than compact_after
+    finished updates.
+    """
+
+    def __init__(self, path, flush_interval=0.2, compact_after=1000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_after = compact_after
+        self.lock = threading.Lock()
+        # update_id -> {"update", "committed"}, in arrival order
+        self.entries = {}
+        self.finished = 0
+        self.dirty = False
+        self._load()
+        self._compact()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="inbox", daemon=True)
+        self.thread.start()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash
+                    logging.warning(f"Skipping damaged inbox line in {self.path}")
+                    continue
+                update_id = record["id"]
+                if record["op"] == "add":
+                    self.entries.setdefault(update_id, {"update": record["update"], "committed": False})
+                elif record["op"] == "commit" and update_id in self.entries:
+                    self.entries[update_id]["committed"] = True
+                elif record["op"] == "done":
+                    self.entries.pop(update_id, None)
+
+    def _compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for update_id, entry in self.entries.items():
+                f.write(json.dumps({"op": "add", "id": update_id, "update": entry["update"]}) + "\n")
+                if entry["committed"]:
+                    f.write(json.dumps({"op": "commit", "id": update_id}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, "a")
+        self.finished = 0
+
+    def _write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.dirty = True
+
+    def add(self, update_id, update):
+        # Returns False if the update is already in the inbox, e.g. when replayed
+        with self.lock:
+            if update_id in self.entries:
+                return False
+            self.entries[update_id] = {"update": update, "committed": False}
+            self._write({"op": "add", "id": update_id, "update": update})
+            return True
+
+    def commit(self, update_id):
+        # The reply is stored or shown, running the turn again would answer twice
+        with self.lock:
+            entry = self.entries.get(update_id)
+            if entry is not None and not entry["committed"]:
+                entry["committed"] = True
+                self._write({"op": "commit", "id": update_id})
+
+    def is_committed(self, update_id):
+        with self.lock:
+            entry = self.entries.get(update_id)
+            return entry is not None and entry["committed"]
+
+    def done(self, update_id):
+        with self.lock:
+            if self.entries.pop(update_id, None) is None:
+                return
+            self._write({"op": "done", "id": update_id})
+            self.finished += 1
+            if self.finished >= self.compact_after:
+                self.file.close()
+                self._compact()
+
+    def pending(self):
+        with self.lock:
+            return [(update_id, entry["update"], entry["committed"]) for update_id, entry in self.entries.items()]
+
+    def depth(self):
+        return len(self.entries)
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                os.fsync(self.file.fileno())
+                self.dirty = False
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        self.flush()
+        with self.lock:
+            self.file.close()
+
+    def _run(self):
+        while not self.closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Flushing the inbox failed: {e}")
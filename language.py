@@ -0,0 +1,118 @@
+import logging
+
+from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
+from langdetect.lang_detect_exception import LangDetectException
+
+import metrics
+from cache import LRUCache
+
+# Unicode blocks the fast path looks at
+HAN = ((0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xF900, 0xFAFF))
+KANA = ((0x3040, 0x30FF),)
+HANGUL = ((0x1100, 0x11FF), (0xAC00, 0xD7AF))
+LATIN = ((0x41, 0x5A), (0x61, 0x7A), (0xC0, 0x24F))
+# One CJK character carries about as much as a short Latin word
+CJK_WEIGHT = 3
+
+
+def normalize_code(code):
+    # langdetect's "zh-cn" and Google's "zh-CN" become the same code
+    language, _, region = code.partition("-")
+    return f"{language.lower()}-{region.upper()}" if region else language.lower()
+
+
+def is_chinese(code):
+    # zh, zh-CN and zh-TW alike
+    return code is not None and code.lower().split("-")[0] == "zh"
+
+
+def _in_blocks(point, blocks):
+    return any(low <= point <= high for low, high in blocks)
+
+
+def script_counts(text):
+    counts = {"han": 0, "kana": 0, "hangul": 0, "latin": 0, "other": 0}
+    for char in text:
+        if not char.isalpha():
+            continue
+        point = ord(char)
+        if _in_blocks(point, LATIN):
+            counts["latin"] += 1
+        elif _in_blocks(point, HAN):
+            counts["han"] += CJK_WEIGHT
+        elif _in_blocks(point, KANA):
+            counts["kana"] += CJK_WEIGHT
+        elif _in_blocks(point, HANGUL):
+            counts["hangul"] += CJK_WEIGHT
+        else:
+            counts["other"] += 1
+    return counts
+
+
+class LanguageDetector:
+    """In-process language identification shared by the bots.
+
+    The script of the text decides first: kana means Japanese, Hangul
+    Korean and Han Chinese, where the loaded langdetect model only picks
+    between zh-CN and zh-TW. Other text goes to the model, and when its
+    best guess is less likely than threshold, or the text has fewer than
+    min_letters letters to judge by, to remote(text) if given.
+    Results are memoised per text. Codes are returned like Google's, e.g.
+    "en", "zh-CN", "zh-TW".
+    """
+
+    def __init__(self, remote=None, threshold=0.8, min_letters=12, cache_size=10000, max_chars=2000):
+        self.remote = remote
+        self.threshold = threshold
+        self.min_letters = min_letters
+        self.max_chars = max_chars
+        # The profiles are loaded once, detectors made from them are cheap
+        DetectorFactory.seed = 0
+        self.factory = DetectorFactory()
+        self.factory.load_profile(PROFILES_DIRECTORY)
+        self.cache = LRUCache(max_entries=cache_size)
+
+    def _probabilities(self, text):
+        detector = self.factory.create()
+        detector.append(text)
+        try:
+            return [(normalize_code(p.lang), p.prob) for p in detector.get_probabilities()]
+        except LangDetectException:
+            return []
+
+    def _chinese_variant(self, text):
+        for code, _ in self._probabilities(text):
+            if code in ("zh-CN", "zh-TW"):
+                return code
+        return "zh-CN"
+
+    def _detect(self, text):
+        counts = script_counts(text)
+        letters = sum(counts.values())
+        cjk = counts["han"] + counts["kana"] + counts["hangul"]
+        if letters and cjk * 2 > letters:
+            metrics.observe("language.script", 1)
+            if counts["kana"]:
+                return "ja"
+            if counts["hangul"] > counts["han"]:
+                return "ko"
+            return self._chinese_variant(text)
+
+        guesses = self._probabilities(text)
+        if guesses and guesses[0][1] >= self.threshold and letters >= self.min_letters:
+            metrics.observe("language.local", 1)
+            return guesses[0][0]
+        if self.remote is not None:
+            metrics.observe("language.remote", 1)
+            try:
+                return normalize_code(self.remote(text))
+            except Exception as e:
+                logging.error(f"Remote language detection failed: {e}")
+        return guesses[0][0] if guesses else "en"
+
+    def detect(self, text):
+        text = text[:self.max_chars]
+        code = self.cache.get(text)
+        if code is None:
+            code = self.cache[text] = self._detect(text)
+        return code
@@ -0,0 +1,164 @@
+import contextvars
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from profiler import SamplingProfiler
+
+# Histogram bucket bounds, 1-2-5 steps from 1ms (or 1 token) up to 50000
+BUCKETS = tuple(m * 10.0 ** e for e in range(-3, 5) for m in (1, 2, 5))
+
+_lock = threading.Lock()
+# name -> {"count", "total", "max", "buckets"}
+_stats = {}
+# name -> callable returning the current value
+_gauges = {}
+# Stage durations of the turn being handled, see trace()
+_trace = contextvars.ContextVar("metrics_trace", default=None)
+
+
+def observe(name, value):
+    with _lock:
+        stat = _stats.get(name)
+        if stat is None:
+            stat = _stats[name] = {"count": 0, "total": 0.0, "max": 0.0, "buckets": [0] * (len(BUCKETS) + 1)}
+        stat["count"] += 1
+        stat["total"] += value
+        stat["max"] = max(stat["max"], value)
+        stat["buckets"][bisect_left(BUCKETS, value)] += 1
+
+
+@contextmanager
+def timer(name):
+    # Record how long the block took, in seconds, whether or not it raised
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(name, elapsed)
+        spans = _trace.get()
+        if spans is not None:
+            spans.append((name, elapsed))
+
+
+@contextmanager
+def trace(name):
+    # Time a whole turn and log how long each timed stage inside it took
+    spans = []
+    token = _trace.set(spans)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _trace.reset(token)
+        elapsed = time.perf_counter() - start
+        observe(name, elapsed)
+        stages = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in spans)
+        logging.info(f"{name} took {elapsed:.3f}s ({stages})")
+
+
+def gauge(name, read):
+    # read() is called whenever the metrics are exported
+    with _lock:
+        _gauges[name] = read
+
+
+def quantile(stat, q):
+    # Upper bound of the bucket holding the q-th quantile
+    rank = q * stat["count"]
+    seen = 0
+    for bound, count in zip(BUCKETS + (float("inf"),), stat["buckets"]):
+        seen += count
+        if seen >= rank and count:
+            return min(bound, stat["max"])
+    return stat["max"]
+
+
+def snapshot(prefix=""):
+    with _lock:
+        return {
+            name: {
+                "count": stat["count"],
+                "total": stat["total"],
+                "max": stat["max"],
+                "mean": stat["total"] / stat["count"],
+                "p50": quantile(stat, 0.5),
+                "p95": quantile(stat, 0.95),
+                "p99": quantile(stat, 0.99),
+            }
+            for name, stat in _stats.items()
+            if name.startswith(prefix)
+        }
+
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+
+
+def prometheus():
+    # Every observed value as a histogram and every gauge, in the Prometheus text format
+    with _lock:
+        stats = {name: dict(stat, buckets=list(stat["buckets"])) for name, stat in _stats.items()}
+        gauges = dict(_gauges)
+
+    lines = []
+    for name, stat in sorted(stats.items()):
+        metric = _metric_name(name)
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for bound, count in zip(BUCKETS, stat["buckets"]):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{le="{bound:g}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{le="+Inf"}} {stat["count"]}')
+        lines.append(f"{metric}_sum {stat['total']}")
+        lines.append(f"{metric}_count {stat['count']}")
+    for name, read in sorted(gauges.items()):
+        try:
+            value = read()
+        except Exception as e:
+            logging.error(f"Reading gauge {name} failed: {e}")
+            continue
+        metric = _metric_name(name)
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+profiler = SamplingProfiler()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/metrics":
+            body = prometheus()
+        elif url.path == "/profile":
+            # e.g. /profile?seconds=30, answers with collapsed stacks
+            seconds = float(parse_qs(url.query).get("seconds", ["10"])[0])
+            body = profiler.profile(min(seconds, 300))
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host="127.0.0.1"):
+    # /metrics for Prometheus and /profile for the sampling profiler, on a background thread
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,107 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+
+async def run_blocking(func, *args, **kwargs):
+    # Run a blocking call (Telegram, Google) in the executor so it can be awaited.
+    # It runs in a copy of the caller's context so its timings land in the caller's trace.
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, functools.partial(context.run, func, *args, **kwargs))
+
+
+class UserPipeline:
+    """Runs handler coroutines on a background event loop.
+
+    Jobs submitted with the same key run one after another in submission
+    order, jobs with different keys run concurrently up to max_concurrency.
+    """
+
+    def __init__(self, max_concurrency=32):
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=max_concurrency * 2))
+        self.thread = threading.Thread(target=self._run, name="user-pipeline", daemon=True)
+        self.semaphore = None
+        # Last scheduled job per key, the next job for that key waits on it
+        self.tails = {}
+        self.pending = 0
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.loop.run_forever()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def submit(self, key, func, *args):
+        # Thread-safe, returns a concurrent.futures.Future for the job
+        return asyncio.run_coroutine_threadsafe(self._schedule(key, func, *args), self.loop)
+
+    async def _schedule(self, key, func, *args):
+        previous = self.tails.get(key)
+        task = asyncio.ensure_future(self._job(previous, func, *args))
+        self.tails[key] = task
+        self.pending += 1
+        metrics.observe("pipeline.queue_depth", self.pending)
+        try:
+            return await task
+        finally:
+            self.pending -= 1
+            if self.tails.get(key) is task:
+                del self.tails[key]
+
+    async def _job(self, previous, func, *args):
+        if previous is not None:
+            # Only ordering matters here, the previous job reports its own errors
+            await asyncio.wait([previous])
+        async with self.semaphore:
+            if asyncio.iscoroutinefunction(func):
+                return await func(*args)
+            return await run_blocking(func, *args)
+
+
+_thread_loops = threading.local()
+
+
+def _thread_loop():
+    # One long-lived loop per handler thread, so sessions bound to it are reused
+    loop = getattr(_thread_loops, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _thread_loops.loop = asyncio.new_event_loop()
+    return loop
+
+
+def run_handler(pipeline, key, func, *args, on_error=None):
+    # Run a handler inline when there is no pipeline, otherwise queue it for the key
+    if pipeline is None:
+        if asyncio.iscoroutinefunction(func):
+            return _thread_loop().run_until_complete(func(*args))
+        return func(*args)
+
+    future = pipeline.submit(key, func, *args)
+
+    def done(f):
+        error = f.exception()
+        if error is None:
+            return
+        if on_error is not None:
+            # Done callbacks run on the loop thread, keep the error reply off it
+            pipeline.loop.run_in_executor(None, on_error, error)
+        else:
+            logging.error(f"Pipeline job for {key} failed: {error}")
+
+    future.add_done_callback(done)
+    return future
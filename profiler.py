@@ -0,0 +1,77 @@
+import collections
+import sys
+import threading
+import time
+
+
+class SamplingProfiler:
+    """Samples the stacks of every thread at a fixed interval.
+
+    Cheap enough to switch on in production for a while: nothing is
+    traced, a background thread just looks at sys._current_frames().
+    collapsed() returns the samples in the "frame;frame;frame count"
+    format that flamegraph tools read.
+    """
+
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.running = threading.Event()
+        self.thread = None
+        # One /profile request at a time
+        self.profile_lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return self
+            self.running.set()
+            self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        self.running.clear()
+        if thread is not None:
+            thread.join()
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+            self.samples = 0
+
+    def _run(self):
+        own = threading.get_ident()
+        while self.running.is_set():
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(stack)))
+            with self.lock:
+                self.counts.update(stacks)
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        with self.lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+    def profile(self, seconds):
+        # Sample for a while and return what was seen, for the /profile endpoint
+        with self.profile_lock:
+            self.reset()
+            self.start()
+            time.sleep(seconds)
+            self.stop()
+            return self.collapsed()
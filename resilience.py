@@ -0,0 +1,150 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import openai
+import requests
+
+import metrics
+
+# Errors that say the backend is struggling, not that the request was wrong
+TRANSIENT_ERRORS = [
+    TimeoutError,
+    ConnectionError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+]
+try:
+    from google.api_core import exceptions as google_errors
+
+    TRANSIENT_ERRORS += [
+        google_errors.ServiceUnavailable,
+        google_errors.DeadlineExceeded,
+        google_errors.InternalServerError,
+        google_errors.TooManyRequests,
+    ]
+except ImportError:
+    pass
+try:
+    from telegram.error import BadRequest, NetworkError, TimedOut
+except ImportError:
+    BadRequest = NetworkError = TimedOut = None
+
+
+class CircuitOpenError(Exception):
+    """The backend failed too often recently and is not being called."""
+
+    def __init__(self, name):
+        super().__init__(f"{name} is unavailable, not calling it for now")
+        self.name = name
+
+
+def is_transient(error):
+    if isinstance(error, CircuitOpenError):
+        return True
+    if NetworkError is not None and isinstance(error, NetworkError):
+        # BadRequest is a NetworkError too, but retrying it won't help
+        return isinstance(error, TimedOut) or not isinstance(error, BadRequest)
+    return isinstance(error, tuple(TRANSIENT_ERRORS))
+
+
+def backoff(attempt, base=0.5, cap=30.0):
+    # Exponential with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Stops calling a backend after failure_threshold transient failures in a row.
+
+    While open, guard() raises CircuitOpenError straight away, so callers
+    fail fast instead of waiting for timeouts. After reset_timeout seconds
+    one call is let through; if it succeeds the breaker closes again,
+    otherwise it stays open for another reset_timeout.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.probing = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def release(self):
+        # A probe ended without telling whether the backend works, e.g. it was cancelled
+        with self.lock:
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.probing:
+                    metrics.observe(f"breaker.{self.name}.opened", 1)
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    @contextmanager
+    def guard(self):
+        if not self.allow():
+            metrics.observe(f"breaker.{self.name}.rejected", 1)
+            raise CircuitOpenError(self.name)
+        try:
+            yield
+        except Exception as e:
+            if is_transient(e):
+                self.failure()
+            else:
+                # The backend answered, the request itself was at fault
+                self.success()
+            raise
+        except BaseException:
+            self.release()
+            raise
+        else:
+            self.success()
+
+
+_lock = threading.Lock()
+_breakers = {}
+_settings = {"failure_threshold": 5, "reset_timeout": 30.0}
+
+
+def configure(failure_threshold=5, reset_timeout=30.0):
+    # Applies to breakers created afterwards
+    _settings.update(failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+
+
+def breaker(name):
+    with _lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **_settings)
+            metrics.gauge(f"breaker.{name}.open", lambda: int(_breakers[name].is_open))
+        return _breakers[name]
@@ -0,0 +1,103 @@
+from telegram import Chat, MessageEntity
+from telegram.ext import MessageFilter
+
+
+def _utf16_slice(text, start, end):
+    # Entity offsets count UTF-16 code units
+    return text.encode("utf-16-le")[2 * start:2 * end].decode("utf-16-le")
+
+
+def _utf16_length(text):
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _find_mention(message, mention):
+    # The entity that mentions @username, case-insensitively like Telegram does
+    for entity in message.entities:
+        if entity.type == MessageEntity.MENTION and message.parse_entity(entity).lower() == mention:
+            return entity
+    return None
+
+
+def text_after_mention(message, username):
+    # The text following the mention of the bot, the whole text without one
+    entity = _find_mention(message, f"@{username}".lower())
+    if entity is None:
+        return message.text
+    return _utf16_slice(message.text, entity.offset + entity.length, _utf16_length(message.text))
+
+
+class BotFilter(MessageFilter):
+    """Base for filters that need the bot's own @username and id.
+
+    Both are read from the first message and kept, the bot caches them
+    after its first getMe call.
+    """
+
+    def __init__(self):
+        self.mention = None
+        self.bot_id = None
+
+    def _bind(self, message):
+        if self.mention is None:
+            self.bot_id = message.bot.id
+            self.mention = f"@{message.bot.username}".lower()
+
+    def _mention(self, message):
+        # The entity that mentions this bot, or None
+        return _find_mention(message, self.mention)
+
+
+class AddressedToBot(BotFilter):
+    """Passes private messages and group messages meant for the bot.
+
+    A group message is meant for the bot when it mentions it or replies to
+    one of its messages. Only the message's entities are looked at, the
+    text itself is never scanned.
+    """
+
+    def filter(self, message):
+        if message.chat.type == Chat.PRIVATE:
+            return True
+        self._bind(message)
+        reply = message.reply_to_message
+        if reply is not None and reply.from_user is not None and reply.from_user.id == self.bot_id:
+            return True
+        return self._mention(message) is not None
+
+
+class MentionedCommand(BotFilter):
+    """Matches "@bot /command args" for the given commands.
+
+    Commands written this way don't start the message, so CommandHandler
+    doesn't see them. On a match, context.group_command holds the command
+    and context.args the words after it.
+    """
+
+    data_filter = True
+
+    def __init__(self, commands):
+        super().__init__()
+        self.commands = frozenset(commands)
+
+    def filter(self, message):
+        if not message.entities:
+            return False
+        self._bind(message)
+        mention = self._mention(message)
+        if mention is None:
+            return False
+        end = mention.offset + mention.length
+        # The command has to follow the mention directly
+        following = [e for e in message.entities if e.offset >= end]
+        if not following or following[0].type != MessageEntity.BOT_COMMAND:
+            return False
+        entity = following[0]
+        if _utf16_slice(message.text, end, entity.offset).strip():
+            return False
+        command, _, target = message.parse_entity(entity)[1:].partition("@")
+        command = command.lower()
+        if command not in self.commands or (target and f"@{target}".lower() != self.mention):
+            return False
+        args = _utf16_slice(message.text, entity.offset + entity.length, _utf16_length(message.text))
+        return {"group_command": [command], "args": args.split()}
@@ -0,0 +1,137 @@
+import logging
+import queue
+import threading
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+import metrics
+from streaming import MESSAGE_LIMIT
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self):
+        # Seconds until a token is available, 0 if one can be taken now
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        # Telegram asked us to back off (RetryAfter)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class SendScheduler:
+    """Sends outgoing messages from one thread within Telegram's flood limits.
+
+    Every message takes a token from its destination's bucket and from a
+    global one. submit() blocks while the queue is full, which slows the
+    producers down instead of piling messages up. RetryAfter pauses the
+    destination for the time Telegram asks for and the message is retried,
+    as are network errors. Messages Telegram rejects (BadRequest, e.g. too
+    long or badly formatted) are dropped straight away. With coalesce on,
+    consecutive queued messages for the same chat are joined into one
+    message as long as it stays under MESSAGE_LIMIT characters. Messages
+    go out in submission order.
+    """
+
+    def __init__(self, bot, chat_rate=1 / 3, chat_burst=3, global_rate=30, max_queue=1000, coalesce=False, max_retries=5):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.buckets = {}
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.coalesce = coalesce
+        self.max_retries = max_retries
+        self.carry = None
+        self.sent = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name="send-scheduler", daemon=True)
+        self.thread.start()
+
+    def submit(self, chat_id, text, parse_mode=None, timeout=None):
+        # Raises queue.Full if there is still no room after timeout seconds
+        self.queue.put((chat_id, text, parse_mode), timeout=timeout)
+        metrics.observe("send_queue.depth", self.queue.qsize())
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def _bucket(self, chat_id):
+        if chat_id not in self.buckets:
+            self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.buckets[chat_id]
+
+    def _next(self):
+        if self.carry is not None:
+            item, self.carry = self.carry, None
+        else:
+            item = self.queue.get()
+        if not self.coalesce:
+            return item
+
+        chat_id, text, parse_mode = item
+        while True:
+            try:
+                following = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            same_target = following[0] == chat_id and following[2] == parse_mode
+            if not same_target or len(text) + 2 + len(following[1]) > MESSAGE_LIMIT:
+                self.carry = following
+                break
+            text = f"{text}\n\n{following[1]}"
+        return chat_id, text, parse_mode
+
+    def _run(self):
+        while True:
+            chat_id, text, parse_mode = self._next()
+            self._send(chat_id, text, parse_mode)
+
+    def _send(self, chat_id, text, parse_mode):
+        bucket = self._bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            wait = max(bucket.wait_time(), self.global_bucket.wait_time())
+            while wait > 0:
+                time.sleep(wait)
+                wait = max(bucket.wait_time(), self.global_bucket.wait_time())
+            bucket.take()
+            self.global_bucket.take()
+            try:
+                with metrics.timer("backend.telegram.send"):
+                    self.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                self.sent += 1
+                return
+            except RetryAfter as e:
+                logging.warning(f"Flood limit for chat {chat_id}, retrying in {e.retry_after}s")
+                bucket.block(e.retry_after)
+            except BadRequest as e:
+                # A NetworkError subclass, but sending it again gets the same answer
+                logging.error(f"Dropping message to chat {chat_id}, Telegram rejected it: {e}")
+                self.dropped += 1
+                return
+            except (TimedOut, NetworkError) as e:
+                logging.warning(f"Sending to chat {chat_id} failed ({e}), retrying")
+                bucket.block(min(2 ** attempt, 30))
+            except Exception as e:
+                logging.error(f"Dropping message to chat {chat_id}: {e}")
+                self.dropped += 1
+                return
+        logging.error(f"Dropping message to chat {chat_id} after {self.max_retries} retries")
+        self.dropped += 1
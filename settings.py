@@ -0,0 +1,64 @@
+import json
+import os
+import sqlite3
+import threading
+
+from cache import LRUCache
+
+# A setting left at None means "use the bot's default"
+DEFAULTS = {
+    "voice": False,
+    "tts_language": None,
+    "tts_voice": None,
+    "model": None,
+    "context_budget": None,
+}
+
+
+class SettingsStore:
+    """Per-user settings, one row per user in a small sqlite table.
+
+    Only values that differ from DEFAULTS are stored. Rows are read on
+    first use and kept in an LRU cache, so a turn costs no query once the
+    user was seen. update() writes through to the table straight away.
+    """
+
+    def __init__(self, path, cache_size=10000):
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS settings (user_id TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID")
+        self.db.commit()
+        self.cache = LRUCache(max_entries=cache_size, loader=self._load)
+
+    def _load(self, user_id):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM settings WHERE user_id = ?", (user_id,)).fetchone()
+        return dict(DEFAULTS, **(json.loads(row[0]) if row else {}))
+
+    def get(self, user_id):
+        # The returned dict is shared with the cache, change it through update()
+        return self.cache[user_id]
+
+    def update(self, user_id, **changes):
+        unknown = set(changes) - set(DEFAULTS)
+        if unknown:
+            raise KeyError(f"Unknown settings: {', '.join(sorted(unknown))}")
+        current = dict(self.cache[user_id], **changes)
+        stored = {name: value for name, value in current.items() if value != DEFAULTS[name]}
+        with self.lock:
+            if stored:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO settings (user_id, data) VALUES (?, ?)",
+                    (user_id, json.dumps(stored, separators=(",", ":"))),
+                )
+            else:
+                self.db.execute("DELETE FROM settings WHERE user_id = ?", (user_id,))
+            self.db.commit()
+        self.cache[user_id] = current
+        return current
+
+    def close(self):
+        with self.lock:
+            self.db.close()
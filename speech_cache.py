@@ -0,0 +1,133 @@
+import hashlib
+import logging
+import os
+import threading
+
+from cache import LRUCache
+
+
+def speech_key(text, language_code, *voice):
+    # Content address of a piece of synthesised speech
+    parts = [language_code, *map(str, voice), text]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+class SpeechCache:
+    """Two-tier cache of synthesised audio, uploaded file_ids and detected languages.
+
+    Audio lives in an in-memory LRU and in {root}/{key[:2]}/{key}.mp3 on
+    disk. The disk tier is capped at max_disk_bytes and drops the least
+    recently used files first (hits refresh the file's mtime). Once audio
+    has been uploaded its file_id is kept next to it as {key}.fid, so the
+    same audio can be re-sent without uploading it again. Detected languages
+    are stored the same way under the hash of the text.
+    """
+
+    def __init__(self, root, max_memory_bytes=32 * 1024 * 1024, max_disk_bytes=512 * 1024 * 1024):
+        self.root = root
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = LRUCache(max_entries=10000, max_bytes=max_memory_bytes, sizeof=len)
+        self.file_ids = LRUCache(max_entries=100000)
+        self.languages = LRUCache(max_entries=100000)
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.disk_bytes = sum(
+            os.path.getsize(os.path.join(path, name))
+            for path, _, names in os.walk(root)
+            for name in names
+        )
+
+    def _path(self, key, suffix):
+        return os.path.join(self.root, key[:2], key + suffix)
+
+    def get_audio(self, key):
+        audio = self.memory.get(key)
+        if audio is not None:
+            return audio
+        path = self._path(key, ".mp3")
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        self.memory[key] = audio
+        return audio
+
+    def put_audio(self, key, audio):
+        self.memory[key] = audio
+        self._write(self._path(key, ".mp3"), audio)
+
+    def get_file_id(self, key):
+        return self._get_small(self.file_ids, key, ".fid")
+
+    def set_file_id(self, key, file_id):
+        self._set_small(self.file_ids, key, ".fid", file_id)
+
+    def forget_file_id(self, key):
+        # Called when Telegram no longer accepts a stored file_id
+        self.file_ids.pop(key)
+        try:
+            os.remove(self._path(key, ".fid"))
+        except FileNotFoundError:
+            pass
+
+    def get_language(self, text):
+        return self._get_small(self.languages, speech_key(text, "lang"), ".lang")
+
+    def set_language(self, text, language_code):
+        self._set_small(self.languages, speech_key(text, "lang"), ".lang", language_code)
+
+    def _get_small(self, tier, key, suffix):
+        value = tier.get(key)
+        if value is None:
+            try:
+                with open(self._path(key, suffix), "r") as f:
+                    value = f.read().strip()
+            except FileNotFoundError:
+                return None
+            tier[key] = value
+        return value
+
+    def _set_small(self, tier, key, suffix, value):
+        tier[key] = value
+        self._write(self._path(key, suffix), value.encode("utf-8"))
+
+    def _write(self, path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.disk_bytes += len(content)
+            if self.disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        # Drop least recently used files until the tier is back under 90% of its cap
+        files = []
+        for path, _, names in os.walk(self.root):
+            for name in names:
+                full_path = os.path.join(path, name)
+                try:
+                    stat = os.stat(full_path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, full_path))
+        files.sort()
+        self.disk_bytes = sum(size for _, size, _ in files)
+        target = self.max_disk_bytes * 0.9
+        for _, size, full_path in files:
+            if self.disk_bytes <= target:
+                break
+            try:
+                os.remove(full_path)
+            except OSError as e:
+                logging.warning(f"Could not evict {full_path}: {e}")
+                continue
+            self.disk_bytes -= size
+            key = os.path.basename(full_path).split(".")[0]
+            self.memory.pop(key)
+            self.file_ids.pop(key)
+            self.languages.pop(key)
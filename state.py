@@ -0,0 +1,99 @@
+import json
+import queue
+import threading
+import zlib
+
+
+def partition(key, partitions):
+    # Stable across processes and restarts, unlike hash()
+    return zlib.crc32(str(key).encode("utf-8")) % partitions
+
+
+class MemoryBackend:
+    """State kept in this process. Fine for a single process, not shared.
+
+    Values are stored JSON-encoded so they behave exactly as they would
+    with RedisBackend: callers always get a fresh copy back.
+    """
+
+    # Other processes can't see this state
+    shared = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.queues = {}
+
+    def get(self, key, default=None):
+        with self.lock:
+            raw = self.values.get(key)
+        return default if raw is None else json.loads(raw)
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = json.dumps(value)
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+    def _queue(self, name):
+        with self.lock:
+            if name not in self.queues:
+                self.queues[name] = queue.Queue()
+            return self.queues[name]
+
+    def push(self, name, item):
+        self._queue(name).put(json.dumps(item))
+
+    def pop(self, name, timeout=None):
+        # Returns None if nothing arrived within timeout seconds
+        try:
+            return json.loads(self._queue(name).get(timeout=timeout))
+        except queue.Empty:
+            return None
+
+
+class RedisBackend:
+    """State shared by every process that points at the same Redis server.
+
+    Anything speaking the Redis protocol works, e.g. a local redis-server,
+    Valkey or KeyDB. Keys are namespaced with prefix so several bots can
+    share one server.
+    """
+
+    shared = True
+
+    def __init__(self, url, prefix="chatbot:"):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        raw = self.redis.get(self.prefix + key)
+        return default if raw is None else json.loads(raw)
+
+    def set(self, key, value):
+        self.redis.set(self.prefix + key, json.dumps(value))
+
+    def delete(self, key):
+        self.redis.delete(self.prefix + key)
+
+    def push(self, name, item):
+        self.redis.rpush(self.prefix + name, json.dumps(item))
+
+    def pop(self, name, timeout=None):
+        # Returns None if nothing arrived within timeout seconds, BLPOP's 0 waits forever
+        result = self.redis.blpop([self.prefix + name], timeout=timeout or 0)
+        return None if result is None else json.loads(result[1])
+
+
+def open_backend(config):
+    # STATE_BACKEND is "memory" (default) or "redis"
+    kind = config.get('STATE_BACKEND', "memory")
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "redis":
+        return RedisBackend(config.get('STATE_URL', "redis://localhost:6379/0"), config.get('STATE_PREFIX', "chatbot:"))
+    raise ValueError(f"Unknown STATE_BACKEND {kind!r}")
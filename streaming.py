@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from pipeline import run_blocking
+
+# Telegram rejects longer message texts
+MESSAGE_LIMIT = 4096
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    # Split on line breaks where possible so each part fits in one message
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+
+class StreamingReply:
+    """Shows a reply while it is generated by editing one message in place.
+
+    The first text is sent as soon as it arrives, after that the message is
+    edited at most once per interval to stay inside Telegram's edit limits.
+    """
+
+    def __init__(self, message, interval=1.0, transform=None):
+        self.message = message
+        self.interval = interval
+        self.transform = transform or (lambda text: text)
+        self.parts = []
+        self.sent = None
+        self.shown = ""
+        self.next_edit = 0.0
+
+    async def feed(self, delta):
+        self.parts.append(delta)
+        if time.monotonic() >= self.next_edit:
+            await self._show(self.transform("".join(self.parts)))
+
+    async def finish(self, text):
+        parts = split_message(text)
+        if self.sent is None:
+            self.sent = await run_blocking(self.message.reply_text, parts[0])
+        elif parts[0] != self.shown:
+            await self._edit(parts[0], final=True)
+        for part in parts[1:]:
+            await run_blocking(self.message.reply_text, part)
+
+    async def _show(self, text):
+        text = text[:MESSAGE_LIMIT]
+        if not text.strip() or text == self.shown:
+            return
+        if self.sent is None:
+            try:
+                self.sent = await run_blocking(self.message.reply_text, text)
+            except BadRequest:
+                raise
+            except NetworkError as e:
+                # A progress update can be skipped, finish() sends the whole reply
+                logging.warning(f"Sending partial reply failed, skipping it: {e}")
+                self.next_edit = time.monotonic() + self.interval
+                return
+            self.shown = text
+            self.next_edit = time.monotonic() + self.interval
+        else:
+            await self._edit(text)
+
+    async def _edit(self, text, final=False):
+        try:
+            await run_blocking(self.sent.edit_text, text)
+            self.shown = text
+            self.next_edit = time.monotonic() + self.interval
+        except RetryAfter as e:
+            # Back off for progress edits, the final text has to get through
+            if not final:
+                self.next_edit = time.monotonic() + e.retry_after
+                return
+            logging.warning(f"Edit rate limited, retrying final reply in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+            await run_blocking(self.sent.edit_text, text)
+            self.shown = text
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                raise
+        except NetworkError as e:
+            # Timeouts and dropped connections skip a progress edit, the next one shows the text
+            if final:
+                raise
+            logging.warning(f"Editing partial reply failed, skipping it: {e}")
+            self.next_edit = time.monotonic() + self.interval
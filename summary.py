@@ -0,0 +1,96 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+
+def summary_applies(summary, messages):
+    # A summary only stands for messages that still start with what it covered
+    if summary is None or summary["covers"] == 0 or summary["covers"] > len(messages):
+        return False
+    return messages[summary["covers"] - 1] == summary["last"]
+
+
+def with_summary(summary, messages):
+    # The summary as a system message followed by the turns it doesn't cover
+    if not summary_applies(summary, messages):
+        return messages
+    note = {"role": "system", "content": f"Summary of the earlier conversation:\n{summary['text']}"}
+    return [note] + messages[summary["covers"]:]
+
+
+class Summarizer:
+    """Folds the older turns of long chats into a rolling summary.
+
+    submit() is called after every turn and only looks at token counts.
+    Once the turns after the current summary exceed trigger_tokens, a
+    background job summarises the oldest of them, at most chunk_tokens at
+    a time, together with the previous summary, until only about
+    keep_tokens of recent turns are left uncovered. summarize(previous,
+    messages) returns the new summary text; count(message) its tokens.
+    """
+
+    def __init__(self, store, summarize, count, trigger_tokens=3000, keep_tokens=1500, chunk_tokens=3000, max_workers=2):
+        self.store = store
+        self.summarize = summarize
+        self.count = count
+        self.trigger_tokens = trigger_tokens
+        self.keep_tokens = keep_tokens
+        self.chunk_tokens = chunk_tokens
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summarizer")
+        self.lock = threading.Lock()
+        self.running = set()
+
+    def _uncovered(self, summary, messages):
+        return summary["covers"] if summary_applies(summary, messages) else 0
+
+    def _cut(self, messages, start):
+        # Where the recent turns begin: keep_tokens from the end, at a user message
+        tokens = 0
+        cut = len(messages)
+        while cut > start and tokens + self.count(messages[cut - 1]) <= self.keep_tokens:
+            cut -= 1
+            tokens += self.count(messages[cut])
+        # The latest exchange is always kept word for word
+        cut = min(cut, len(messages) - 1)
+        while cut > start and messages[cut].get("role") != "user":
+            cut -= 1
+        # Summarise at most chunk_tokens per pass, a later pass takes the rest
+        end, tokens = start, 0
+        while end < cut and (end == start or tokens + self.count(messages[end]) <= self.chunk_tokens):
+            tokens += self.count(messages[end])
+            end += 1
+        return end
+
+    def submit(self, user_id, messages, name="default"):
+        summary = self.store.read_summary(user_id, name)
+        start = self._uncovered(summary, messages)
+        if sum(self.count(m) for m in messages[start:]) <= self.trigger_tokens:
+            return
+        key = (user_id, name)
+        with self.lock:
+            if key in self.running:
+                return
+            self.running.add(key)
+        self.executor.submit(self._run, key, list(messages))
+
+    def _run(self, key, messages):
+        user_id, name = key
+        try:
+            while True:
+                summary = self.store.read_summary(user_id, name)
+                start = self._uncovered(summary, messages)
+                end = self._cut(messages, start)
+                if end <= start:
+                    break
+                previous = summary["text"] if start else None
+                with metrics.timer("summary.generate"):
+                    text = self.summarize(previous, messages[start:end])
+                self.store.save_summary(user_id, {"text": text, "covers": end, "last": messages[end - 1]}, name)
+                metrics.observe("summary.covered_turns", end - start)
+        except Exception as e:
+            logging.error(f"Summarising the chat of {user_id} failed: {e}")
+        finally:
+            with self.lock:
+                self.running.discard(key)
@@ -0,0 +1,257 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from history_store import HistoryStore
+
+
+def turns(*texts):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": text} for i, text in enumerate(texts)]
+
+
+class HistoryStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="history-store-")
+        self.store = self.open()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def open(self, **options):
+        return HistoryStore(self.root, flush_interval=60, compact_interval=3600, **options)
+
+    def reopen(self, **options):
+        self.store.close()
+        self.store = self.open(**options)
+
+    def logs(self, user_id):
+        return sorted(name for name in os.listdir(f"{self.root}/{user_id}") if name.endswith(".log"))
+
+    def log_lines(self, user_id, log):
+        with open(f"{self.root}/{user_id}/{user_id}_{log}.log") as f:
+            return [json.loads(line) for line in f]
+
+    def ref(self, user_id, name):
+        with open(f"{self.root}/{user_id}/{user_id}.refs.json") as f:
+            return json.load(f)[name]
+
+    def test_save_appends_only_new_turns(self):
+        self.store.save("u", turns("a", "b"))
+        self.store.save("u", turns("a", "b", "c", "d"))
+        self.reopen()
+        self.assertEqual(self.store.read("u"), turns("a", "b", "c", "d"))
+        self.assertEqual(len(self.logs("u")), 1)
+        self.assertEqual(len(self.log_lines("u", self.ref("u", "default")["log"])), 4)
+
+    def test_unrelated_save_starts_a_new_log(self):
+        self.store.save("u", turns("a", "b"))
+        self.store.save("u", turns("x"))
+        self.assertEqual(self.store.read("u"), turns("x"))
+
+    def test_torn_last_line_is_truncated(self):
+        self.store.save("u", turns("a", "b"))
+        self.store.flush()
+        path = f"{self.root}/u/u_{self.ref('u', 'default')['log']}.log"
+        size = os.path.getsize(path)
+        with open(path, "a") as f:
+            f.write('{"role": "user", "cont')
+        self.reopen()
+        self.assertEqual(self.store.read("u"), turns("a", "b"))
+        self.assertEqual(os.path.getsize(path), size)
+        # Appending after the repair continues on a clean line
+        self.store.save("u", turns("a", "b", "c"))
+        self.reopen()
+        self.assertEqual(self.store.read("u"), turns("a", "b", "c"))
+
+    def test_cold_tail_and_snapshot_do_not_parse_the_log(self):
+        messages = turns(*[str(i) for i in range(200)])
+        self.store.save("u", messages)
+        self.reopen()
+        with mock.patch("json.loads", wraps=json.loads) as loads:
+            self.assertEqual(self.store.read_tail("u", "default", 2), messages[-2:])
+            self.assertTrue(self.store.snapshot("u", "default", "saved"))
+        self.assertLess(loads.call_count, 10)
+        self.assertEqual(self.store.read("u", "saved"), messages)
+
+    def test_snapshot_shares_the_log(self):
+        self.store.save("u", turns("a", "b"))
+        self.assertTrue(self.store.snapshot("u", "default", "saved"))
+        self.store.save("u", turns("a", "b", "c"))
+        self.assertEqual(self.store.read("u", "saved"), turns("a", "b"))
+        self.assertEqual(self.store.read("u"), turns("a", "b", "c"))
+        self.assertEqual(len(self.logs("u")), 1)
+
+    def test_branch_records_its_parent(self):
+        self.store.save("u", turns("a", "b"))
+        self.store.snapshot("u", "default", "saved")
+        self.store.save("u", turns("a", "b", "c"))
+        self.assertEqual(self.store.read("u", "saved"), turns("a", "b"))
+        self.store.save("u", turns("a", "b", "d"), "saved")
+        self.reopen()
+        self.assertEqual(self.store.read("u", "saved"), turns("a", "b", "d"))
+        self.assertEqual(self.store.read("u"), turns("a", "b", "c"))
+        branch = self.log_lines("u", self.ref("u", "saved")["log"])
+        self.assertEqual(branch[0], {"parent": self.ref("u", "default")["log"], "length": 2})
+        self.assertEqual(branch[1:], turns("a", "b", "d")[2:])
+        self.assertEqual(self.store.read_tail("u", "saved", 2), turns("a", "b", "d")[1:])
+
+    def test_compaction_flattens_chains_and_drops_unreachable_logs(self):
+        self.reopen(max_chain=2)
+        messages = turns("a")
+        self.store.save("u", messages)
+        for text in "bcd":
+            # Each round branches "branch" off a shared prefix, growing its chain
+            self.store.snapshot("u", "default", "branch")
+            self.store.save("u", messages + turns("x"))
+            self.store.read("u", "branch")
+            messages = messages + turns(text)
+            self.store.save("u", messages, "branch")
+            self.store.snapshot("u", "branch", "default")
+            self.store.read("u")
+        self.store.save("u", turns("z"), "old")
+        self.store.save("u", turns("y"), "old")
+        with self.store.lock:
+            self.store._compact("u")
+        self.reopen(max_chain=2)
+        self.assertEqual(self.store.read("u", "branch"), messages)
+        self.assertEqual(self.store.read("u"), messages)
+        self.assertEqual(self.store.read("u", "old"), turns("y"))
+        with self.store.lock:
+            reachable = set()
+            for ref in self.store._user_refs("u").values():
+                self.assertLessEqual(self.store._chain_depth("u", ref["log"]), 2)
+                log = ref["log"]
+                while log is not None:
+                    reachable.add(f"u_{log}.log")
+                    log = self.store._log_info("u", log)["parent"]
+        self.assertEqual(set(self.logs("u")), reachable)
+
+    def test_legacy_file_is_imported(self):
+        os.makedirs(f"{self.root}/u")
+        with open(f"{self.root}/u/u_old.json", "w") as f:
+            json.dump(turns("a", "b"), f)
+        self.assertTrue(self.store.exists("u", "old"))
+        self.assertEqual(self.store.read("u", "old"), turns("a", "b"))
+        self.assertEqual(self.store.catalog("u")["old"]["turns"], 2)
+        self.reopen()
+        self.assertEqual(self.store.read("u", "old"), turns("a", "b"))
+
+    def test_catalog_looks_for_legacy_files_once(self):
+        os.makedirs(f"{self.root}/u")
+        with open(f"{self.root}/u/u_old.json", "w") as f:
+            json.dump(turns("a"), f)
+        with mock.patch("os.listdir", wraps=os.listdir) as listdir:
+            self.assertEqual(list(self.store.catalog("u")), ["old"])
+            self.assertEqual(list(self.store.catalog("u")), ["old"])
+            self.assertEqual(self.store.search("u", "a")[0][0], "old")
+        self.assertEqual(listdir.call_count, 1)
+
+    def test_invalid_legacy_name_is_not_imported(self):
+        self.assertFalse(self.store.exists("u", "../u_old"))
+
+    def test_summary_is_copied_by_snapshot(self):
+        summary = {"text": "short", "covers": 1, "last": turns("a")[0]}
+        self.store.save("u", turns("a", "b"))
+        self.store.save_summary("u", summary)
+        self.store.snapshot("u", "default", "saved")
+        self.reopen()
+        self.assertEqual(self.store.read_summary("u", "saved"), summary)
+
+    def test_new_log_drops_the_old_summary(self):
+        self.store.save("u", turns("ok", "b"))
+        self.store.save_summary("u", {"text": "short", "covers": 1, "last": turns("ok")[0]})
+        self.store.save("u", [])
+        self.store.save("u", turns("ok"))
+        self.reopen()
+        self.assertIsNone(self.store.read_summary("u"))
+
+    def test_forget_drops_user_state(self):
+        self.store.save("u", turns("a"))
+        self.store.save("u", turns("a", "b"))
+        self.store.save_summary("u", {"text": "short", "covers": 1, "last": turns("a")[0]})
+        self.store.forget("u")
+        self.assertFalse(any(key[0] == "u" for key in self.store.known))
+        self.assertNotIn("u", self.store.refs)
+        self.assertNotIn("u", self.store.summaries)
+        # The unwritten log is kept until the next flush has written it
+        self.assertTrue(any(key[0] == "u" for key in self.store.logs))
+        self.store.flush()
+        self.assertFalse(any(key[0] == "u" for key in self.store.logs))
+        self.assertEqual(self.store.read("u"), turns("a", "b"))
+        self.store.save("u", turns("a", "b", "c"))
+        self.assertEqual(len(self.logs("u")), 1)
+        self.assertEqual(self.store.read_summary("u")["text"], "short")
+
+    def test_sync_writes_the_ref_log(self):
+        self.store.save("u", turns("a"))
+        self.store.save("u", turns("a", "b"))
+        self.store.sync("u")
+        self.assertEqual(self.log_lines("u", self.ref("u", "default")["log"]), turns("a", "b"))
+
+    def test_reads_do_not_wait_for_the_background_write(self):
+        writing = threading.Event()
+        release = threading.Event()
+        write_lines = self.store._write_lines
+
+        def slow_write(path, records):
+            writing.set()
+            release.wait(5)
+            write_lines(path, records)
+
+        self.store.save("v", turns("a"))
+        self.store.save("u", turns("a", "b"))
+        self.store.save("u", turns("a", "b", "c"))
+        self.store._write_lines = slow_write
+        flusher = threading.Thread(target=self.store.flush)
+        flusher.start()
+        self.assertTrue(writing.wait(5))
+        # Another user's lookups go ahead while the write is stuck
+        done = threading.Event()
+        threading.Thread(target=lambda: (self.store.exists("w"), self.store.read_summary("v"), done.set())).start()
+        self.assertTrue(done.wait(2))
+        release.set()
+        flusher.join()
+        self.store._write_lines = write_lines
+        self.assertEqual(self.store.read("u"), turns("a", "b", "c"))
+
+    def test_failed_write_is_retried_without_blocking_reads(self):
+        writing = threading.Event()
+        release = threading.Event()
+        write_lines = self.store._write_lines
+
+        def failing_write(path, records):
+            self.store._write_lines = write_lines
+            writing.set()
+            release.wait(5)
+            raise OSError("disk full")
+
+        def flush():
+            with self.assertRaises(OSError):
+                self.store.flush()
+
+        self.store.save("u", turns("a", "b"))
+        self.store.save("u", turns("a", "b", "c"))
+        self.store._write_lines = failing_write
+        flusher = threading.Thread(target=flush, daemon=True)
+        flusher.start()
+        self.assertTrue(writing.wait(5))
+        # A read of the same log waits for the write, then writes the lines itself
+        messages = []
+        reader = threading.Thread(target=lambda: messages.append(self.store.read("u")), daemon=True)
+        reader.start()
+        release.set()
+        flusher.join(5)
+        reader.join(5)
+        self.assertFalse(flusher.is_alive() or reader.is_alive())
+        self.assertEqual(messages, [turns("a", "b", "c")])
+        self.reopen()
+        self.assertEqual(self.store.read("u"), turns("a", "b", "c"))
+
+
+if __name__ == "__main__":
+    unittest.main()
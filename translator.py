@@ -0,0 +1,102 @@
+import logging
+import queue
+import threading
+import time
+
+import metrics
+from cache import LRUCache
+
+
+def normalize(text):
+    # Messages that only differ in spacing share one translation, line breaks are kept
+    return "\n".join(" ".join(line.split()) for line in text.strip().splitlines())
+
+
+class TranslationBatcher:
+    """Translates forwarded messages in small batches, keeping their order.
+
+    submit() queues a text (or None when no translation is needed) with a
+    callback. A background thread gathers everything that arrives within
+    window seconds, answers what it can from a TTL cache, translates the
+    remaining distinct texts with one translate_many(texts) call and then
+    runs the callbacks in submission order with the translation, or None.
+    submit() blocks while max_queue texts are waiting, so a slow
+    translation API slows the producers down instead of piling texts up.
+    """
+
+    def __init__(self, translate_many, window=0.05, max_batch=100, max_chars=30000, cache_ttl=3600, cache_size=10000,
+                 max_queue=1000):
+        self.translate_many = translate_many
+        self.window = window
+        self.max_batch = max_batch
+        self.max_chars = max_chars
+        self.cache = LRUCache(max_entries=cache_size, ttl=cache_ttl)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.api_calls = 0
+        self.thread = threading.Thread(target=self._run, name="translation-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, text, callback, timeout=None):
+        # Raises queue.Full if there is still no room after timeout seconds
+        self.queue.put((text, callback), timeout=timeout)
+
+    def translate(self, text):
+        # Blocking convenience wrapper around submit()
+        done = threading.Event()
+        result = []
+
+        def callback(translated):
+            result.append(translated)
+            done.set()
+
+        self.submit(text, callback)
+        done.wait()
+        return result[0]
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            chars = len(batch[0][0] or "")
+            while len(batch) < self.max_batch and chars < self.max_chars:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                chars += len(item[0] or "")
+            self._process(batch)
+
+    def _process(self, batch):
+        metrics.observe("translator.batch_size", len(batch))
+        translations = {}
+        missing = []
+        for text, _ in batch:
+            if text is None:
+                continue
+            key = normalize(text)
+            if key in translations:
+                continue
+            cached = self.cache.get(key)
+            translations[key] = cached
+            if cached is None:
+                missing.append(key)
+
+        if missing:
+            metrics.observe("translator.batch_chars", sum(len(key) for key in missing))
+            try:
+                self.api_calls += 1
+                for key, translated in zip(missing, self.translate_many(missing)):
+                    translations[key] = translated
+                    self.cache[key] = translated
+            except Exception as e:
+                logging.error(f"Translating {len(missing)} messages failed: {e}")
+
+        for text, callback in batch:
+            try:
+                callback(None if text is None else translations.get(normalize(text)))
+            except Exception as e:
+                logging.error(f"Translation callback failed: {e}")
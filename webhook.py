@@ -0,0 +1,93 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+import state
+
+
+def update_key(data):
+    # The user an update belongs to, or its chat, so one user's updates share a partition
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("chat") or (value.get("message") or {}).get("chat")
+            if sender and "id" in sender:
+                return sender["id"]
+    return data.get("update_id", 0)
+
+
+def queue_name(partition):
+    return f"updates:{partition}"
+
+
+class WebhookIngress:
+    """Receives Telegram webhook calls and queues each update for its partition.
+
+    Updates are partitioned by user id, so exactly one worker handles a
+    given user and that user's updates stay in order. The HTTP answer is
+    sent as soon as the update is queued, the work happens in the workers.
+    """
+
+    def __init__(self, backend, partitions, listen="0.0.0.0", port=8443, path="/"):
+        self.backend = backend
+        self.partitions = partitions
+        self.path = path
+        ingress = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != ingress.path:
+                    self.send_error(404)
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    data = json.loads(self.rfile.read(length))
+                except ValueError:
+                    self.send_error(400)
+                    return
+                ingress.push(data)
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((listen, port), Handler)
+        self.server.daemon_threads = True
+
+    def push(self, data):
+        self.backend.push(queue_name(state.partition(update_key(data), self.partitions)), data)
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="webhook-ingress", daemon=True).start()
+        return self
+
+
+def run_worker(backend, partition, dispatcher, stop=None):
+    # Handles the updates of one partition in the order they arrived.
+    # Delivery is at most once: an update is popped before it is handled, so
+    # one in hand when the worker dies is lost. The bot journals text and
+    # voice turns in its inbox as soon as the dispatcher accepts them, which
+    # leaves only the dispatcher's own filtering in that window.
+    name = queue_name(partition)
+    while stop is None or not stop.is_set():
+        data = backend.pop(name, timeout=1)
+        if data is None:
+            continue
+        try:
+            dispatcher.process_update(Update.de_json(data, dispatcher.bot))
+        except Exception as e:
+            logging.error(f"Worker {partition} failed on update {data.get('update_id')}: {e}")
+
+
+def start_workers(backend, partitions, dispatcher):
+    for partition in partitions:
+        threading.Thread(
+            target=run_worker, args=(backend, partition, dispatcher), name=f"webhook-worker-{partition}", daemon=True
+        ).start()